@@ -4,7 +4,6 @@
 
 
 from media_test_harness.testcase import MediaTestCase
-from media_utils.video_puppeteer import VideoPuppeteer
 
 
 class TestFullPlayback(MediaTestCase):
@@ -13,12 +12,10 @@ class TestFullPlayback(MediaTestCase):
     These tests should pass on any site where a single video element plays
     upon loading and is uninterrupted (by ads, for example). This will play
     the full videos, so it could take a while depending on the videos playing.
-    It should be run much less frequently in automated systems.
+    It should be run much less frequently in automated systems. Use
+    --playback-rate to play the videos faster than real time.
     """
 
     def test_video_playback_full(self):
-        with self.marionette.using_context('content'):
-            for url in self.video_urls:
-                video = VideoPuppeteer(self.marionette, url,
-                                       stall_wait_time=10)
-                self.run_playback(video)
+        self.run_playbacks(self.video_urls, stall_wait_time=10,
+                           playback_rate=self.playback_rate)
@@ -0,0 +1,22 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+from marionette import BrowserMobProxyTestCaseMixin
+
+from media_test_harness.testcase import NetworkBandwidthTestCase
+
+
+class TestMinimumBandwidth(NetworkBandwidthTestCase,
+                           BrowserMobProxyTestCaseMixin):
+
+    def test_min_sustainable_bandwidth(self):
+        failures = []
+        for url in self.media_urls():
+            result = self.search_min_bandwidth(url)
+            if result.min_kbps is None:
+                failures.append('%s: %s' % (url, result.probes[-1].reason))
+        if failures:
+            raise self.failureException(
+                '\n'.join(['Playback failed at the highest bandwidth:'] +
+                          failures))
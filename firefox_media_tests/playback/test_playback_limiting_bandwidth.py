@@ -5,6 +5,7 @@
 from marionette import BrowserMobProxyTestCaseMixin
 
 from media_utils.video_puppeteer import VideoPuppeteer
+from media_test_harness.bandwidth_trace import BandwidthTrace
 from media_test_harness.testcase import NetworkBandwidthTestCase
 
 
@@ -22,3 +23,16 @@ class TestPlaybackLimitingBandwidth(NetworkBandwidthTestCase,
     def test_playback_limiting_bandwidth_1000(self):
         self.proxy.limits({'downstream_kbps': 1000})
         self.run_videos()
+
+    def test_playback_limiting_bandwidth_tiers(self):
+        # Through BrowserMob, the tiers would play one after another, as in
+        # the tests above
+        if not self.local_throttle:
+            self.skipTest('Tiers play concurrently only with --local-throttle')
+        self.run_tiers([250, 500, 1000])
+
+    def test_playback_bandwidth_trace(self):
+        # --bandwidth-trace, or 1000 and 250 kbps in turn every 15 seconds
+        trace = (self.bandwidth_trace or
+                 BandwidthTrace.alternating(1000, 250, 15))
+        self.run_videos_with_trace(trace)
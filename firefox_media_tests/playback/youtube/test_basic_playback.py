@@ -19,7 +19,7 @@ class TestBasicYouTubePlayback(MediaTestCase):
                                        timeout=60)
             wait = Wait(youtube,
                         timeout=min(300, youtube.expected_duration * 1.3),
-                        interval=1)
+                        interval=1, clock=youtube.clock)
             try:
                 verbose_until(wait, youtube,
                               lambda y: y.video_src.startswith('mediasource'),
@@ -58,7 +58,7 @@ class TestBasicYouTubePlayback(MediaTestCase):
                 try:
                     verbose_until(Wait(youtube,
                                        timeout=max(100, time_left) * 1.3,
-                                       interval=1),
+                                       interval=1, clock=youtube.clock),
                                   youtube,
                                   playback_done)
                 except TimeoutException as e:
@@ -41,7 +41,7 @@ class TestMediaSourcePrefs(MediaTestCase):
             wait = Wait(youtube,
                         timeout=min(self.max_timeout,
                                     youtube.player_duration * 1.3),
-                        interval=1)
+                        interval=1, clock=youtube.clock)
 
             def cond(y):
                 return y.video_src.startswith(src_type)
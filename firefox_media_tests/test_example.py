@@ -2,6 +2,8 @@ from media_test_harness.testcase import MediaTestCase
 
 
 class TestSomethingElse(MediaTestCase):
+    uses_video_urls = False
+
     def setUp(self):
         MediaTestCase.setUp(self)
         self.test_urls = [
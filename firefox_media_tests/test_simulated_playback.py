@@ -0,0 +1,102 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+from marionette_driver import Wait
+
+from media_test_harness.testcase import MediaTestCase
+from media_utils.fake_marionette import (FakeMarionette, SimulatedAd,
+                                         SimulatedPlayer, SimulatedVideo,
+                                         VirtualClock)
+from media_utils.video_puppeteer import playback_done, VideoPuppeteer
+from media_utils.youtube_puppeteer import (playback_done as yt_playback_done,
+                                           wait_for_almost_done,
+                                           YouTubePuppeteer)
+
+
+class TestSimulatedPlayback(MediaTestCase):
+    """ Drive the puppeteers through FakeMarionette.
+
+    Every script the puppeteers send must be understood by FakeMarionette,
+    so a script that changes without the fake following fails here with
+    UnsupportedScript. Playback runs on a VirtualClock, so these tests take
+    seconds whatever the simulated durations.
+    """
+    uses_video_urls = False
+    url = 'http://simulated/video'
+    yt_url = 'https://www.youtube.com/watch?v=simulated'
+
+    def setUp(self):
+        MediaTestCase.setUp(self)
+        self.virtual_clock = VirtualClock()
+        self.fake = FakeMarionette(self.virtual_clock, latency=0.005)
+
+    def test_video_puppeteer_polling(self):
+        self.fake.add_page(self.url, SimulatedVideo(self.virtual_clock, 300,
+                                                    stalls=[(40, 5)]))
+        video = VideoPuppeteer(self.fake, self.url, clock=self.virtual_clock,
+                               set_duration=120, stall_wait_time=30,
+                               playback_rate=2, debug_interval=10,
+                               resource_interval=5)
+        Wait(video, interval=video.interval,
+             timeout=video.max_wall_duration * 1.3 + video.stall_wait_time,
+             clock=self.virtual_clock).until(playback_done)
+        self.assertEqual(video.playback_rate, 2)
+        self.assertEqual(len(video.qoe.stalls), 1)
+        self.assertTrue(len(video.metrics))
+        self.assertTrue(len(video.resources))
+        self.assertTrue(video.get_debug_lines())
+        self.assertIn(self.url, str(video))
+
+    def test_video_puppeteer_event_driven(self):
+        self.fake.add_page(self.url,
+                           SimulatedVideo(self.virtual_clock, 300,
+                                          stalls=[(40, 5), (80, 2)]))
+        video = VideoPuppeteer(self.fake, self.url, clock=self.virtual_clock,
+                               set_duration=100, stall_wait_time=30)
+        video.wait_for_playback_start()
+        summary = video.wait_for_playback_end(video.max_wall_duration * 1.3,
+                                              chunk=30)
+        self.assertEqual(summary.reason, 'duration')
+        self.assertEqual(len(video.qoe.stalls), 2)
+        self.assertIsNone(video.sampler)
+
+    def test_resource_timing_buffer_full(self):
+        page = self.fake.add_page(self.url,
+                                  SimulatedVideo(self.virtual_clock, 300))
+        video = VideoPuppeteer(self.fake, self.url, clock=self.virtual_clock)
+        self.assertEqual(self.fake.scripts['resource_buffer'], 1)
+        page.resource_buffer_size = 4
+        for i in range(3):
+            self.virtual_clock.sleep(20)
+            video.capture_resource_timing()
+        self.assertGreater(len(video.resources), 4)
+        self.assertTrue(video.resources.to_dict()['buffer_full'])
+        self.assertIn('WARNING', [level for level, msg in self.fake.logs])
+
+    def test_round_trip_jitter(self):
+        self.fake.add_page(self.url, SimulatedVideo(self.virtual_clock, 300))
+        video = VideoPuppeteer(self.fake, self.url, clock=self.virtual_clock)
+        video.wait_for_playback_start()
+        # the element is read as soon as the script is sent, and the
+        # response to the eleventh read is late
+        self.fake.split = 0
+        for latency in [0.05] * 10 + [0.6] + [0.05] * 10:
+            self.fake.latency = latency
+            video.snapshot()
+        self.assertEqual(len(video.qoe.stalls), 0)
+
+    def test_youtube_puppeteer(self):
+        video = SimulatedVideo(self.virtual_clock, 600)
+        player = SimulatedPlayer(video, ads=[
+            SimulatedAd(0, 15, skippable_after=5), SimulatedAd(300, 20)])
+        self.fake.add_page(self.yt_url, video, player)
+        youtube = YouTubePuppeteer(self.fake, self.yt_url,
+                                   clock=self.virtual_clock)
+        self.assertEqual(youtube.movie_id, 'simulated')
+        self.assertEqual(youtube.expected_duration, 600)
+        wait_for_almost_done(youtube, final_piece=60)
+        Wait(youtube, interval=1, timeout=120,
+             clock=self.virtual_clock).until(yt_playback_done)
+        self.assertEqual(player.ads_played, 2)
+        self.assertIn(self.yt_url, str(youtube))
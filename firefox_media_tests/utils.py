@@ -2,6 +2,7 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
 
+from collections import deque
 import datetime
 import time
 import types
@@ -13,11 +14,15 @@ def timestamp_now():
     return int(time.mktime(datetime.datetime.now().timetuple()))
 
 
-def verbose_until(wait, target, condition, message=""):
+def verbose_until(wait, target, condition, message="", history=5):
     """
     Performs a `wait`.until(condition)` and adds information about the state of
     `target` to any resulting `TimeoutException`.
 
+    The state of `target` is only captured if the wait times out, so it shows
+    what was true at that moment and costs nothing when the wait succeeds.
+    The results of the last few polls of `condition` are reported with it.
+
     :param wait: a `marionette.Wait` instance
     :param target: the object you want verbose output about if a
         `TimeoutException` is raised
@@ -25,6 +30,7 @@ def verbose_until(wait, target, condition, message=""):
         `wait`. Ideally, `target` should implement `__str__`
     :param condition: callable function used by `wait.until()`
     :param message: optional message to log when exception occurs
+    :param history: number of recent poll results to report
 
     :return: the result of `wait.until(condition)`
     """
@@ -32,12 +38,38 @@ def verbose_until(wait, target, condition, message=""):
         name = condition.__name__
     else:
         name = str(condition)
-    err_message = '\n'.join([message,
-                             'condition: ' + name,
-                             str(target)])
+    start = wait.clock.now
+    # (seconds since start, result or exception raised)
+    polls = deque(maxlen=history)
+
+    def recorded(value):
+        try:
+            result = condition(value)
+        except Exception as e:
+            polls.append((wait.clock.now - start,
+                          '%s: %s' % (type(e).__name__, e)))
+            raise
+        polls.append((wait.clock.now - start, result))
+        return result
+
+    try:
+        return wait.until(recorded)
+    except TimeoutException as e:
+        lines = [message, 'condition: ' + name,
+                 'last %s polls:' % len(polls)]
+        lines += ['\t%.1f s: %s' % (elapsed, _truncate(repr(result)))
+                  for elapsed, result in polls]
+        try:
+            lines.append(str(target))
+        except Exception as err:
+            lines.append('Could not get state of target: %s' % err)
+        raise TimeoutException('%s\n%s' % (e, '\n'.join(lines)))
 
-    return wait.until(condition, message=err_message)
 
+def _truncate(text, length=100):
+    if len(text) <= length:
+        return text
+    return text[:length - 3] + '...'
 
 
 def save_memory_report(marionette):
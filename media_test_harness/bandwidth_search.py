@@ -0,0 +1,67 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+from collections import namedtuple
+
+
+class Probe(namedtuple('Probe', ['downstream_kbps', 'passed', 'reason'])):
+    """
+    One playback at a fixed bandwidth during a search.
+
+    reason - why playback failed, or None if it passed.
+    """
+    __slots__ = ()
+
+
+class SearchResult(namedtuple('SearchResult', ['min_kbps', 'probes'])):
+    """
+    Outcome of search_min_bandwidth.
+
+    min_kbps - lowest bandwidth found to play well, to within the search
+        precision, or None if playback failed even at the upper bound.
+    probes - the Probes run, in order.
+    """
+    __slots__ = ()
+
+    @property
+    def max_failing_kbps(self):
+        """ Highest bandwidth at which playback failed, or None. """
+        failing = [probe.downstream_kbps for probe in self.probes
+                   if not probe.passed]
+        return max(failing) if failing else None
+
+
+def search_min_bandwidth(play, low, high, precision):
+    """
+    Bisect downstream bandwidth between `low` and `high` kbps for the lowest
+    rate at which playback passes, assuming that it passes at any rate above
+    one at which it passes.
+
+    The upper bound is probed first, then the lower bound, so a search
+    takes at most 2 + log2((high - low) / precision) playbacks.
+
+    :param play: function that plays at a given kbps and returns a failure
+        message, or None if playback passed
+    :param precision: stop once the passing and failing rates are at most
+        this many kbps apart
+    :return: SearchResult
+    """
+    probes = []
+
+    def passes(kbps):
+        reason = play(kbps)
+        probes.append(Probe(kbps, reason is None, reason))
+        return reason is None
+
+    if not passes(high):
+        return SearchResult(None, probes)
+    if passes(low):
+        return SearchResult(low, probes)
+    while high - low > precision:
+        middle = (low + high) / 2.0
+        if passes(middle):
+            high = middle
+        else:
+            low = middle
+    return SearchResult(high, probes)
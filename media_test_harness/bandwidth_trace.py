@@ -0,0 +1,202 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+from bisect import bisect_right
+from collections import namedtuple
+import csv
+import json
+import threading
+
+
+class TracePoint(namedtuple('TracePoint', ['time', 'downstream_kbps',
+                                           'latency'])):
+    """
+    Network limits that apply from `time` seconds into a BandwidthTrace
+    until the next point.
+
+    downstream_kbps - 0 means unlimited.
+    latency - in milliseconds, or None to leave latency unchanged.
+    """
+    __slots__ = ()
+
+    def limits(self):
+        """ Return the options for proxy.limits that apply this point. """
+        options = {'downstream_kbps': self.downstream_kbps}
+        if self.latency is not None:
+            options['latency'] = self.latency
+        return options
+
+
+class BandwidthTrace(object):
+    """
+    A profile of downstream bandwidth and latency over time, as a series of
+    steps.
+
+    Inputs:
+        points - TracePoints or (time, downstream_kbps[, latency]) tuples;
+            the first one should be at time 0.
+        period - If set, the trace repeats every `period` seconds; otherwise
+            the last point applies forever.
+    """
+    def __init__(self, points, period=None):
+        self.points = sorted(TracePoint(*(tuple(point) + (None,))[:3])
+                             for point in points)
+        if not self.points:
+            raise ValueError('A bandwidth trace needs at least one point')
+        self.period = period
+        self._times = [point.time for point in self.points]
+
+    def __len__(self):
+        return len(self.points)
+
+    def at(self, t):
+        """ Return the TracePoint in effect `t` seconds into the trace. """
+        if self.period:
+            t %= self.period
+        return self.points[max(bisect_right(self._times, t) - 1, 0)]
+
+    def next_change(self, t):
+        """
+        Return the time, in seconds into the trace, of the first point after
+        `t`, or None if the trace does not change after `t`.
+        """
+        if self.period:
+            cycle = t - t % self.period
+            index = bisect_right(self._times, t - cycle)
+            if index == len(self._times):
+                return cycle + self.period
+            return cycle + self._times[index]
+        index = bisect_right(self._times, t)
+        if index < len(self._times):
+            return self._times[index]
+
+    def to_dict(self):
+        return {
+            'period': self.period,
+            'points': [point._asdict() for point in self.points],
+        }
+
+    @classmethod
+    def alternating(cls, high_kbps, low_kbps, period, latency=None):
+        """
+        Return a trace that switches between `high_kbps` and `low_kbps`
+        every `period` seconds, starting high.
+        """
+        return cls([(0, high_kbps, latency), (period, low_kbps, latency)],
+                   period=2 * period)
+
+    @classmethod
+    def from_file(cls, path):
+        """
+        Read a trace from `path`, either:
+            JSON - a list of points, or an object with 'points' and an
+                optional 'period'; each point is a [time, downstream_kbps,
+                latency] list or an object with those keys.
+            CSV - rows of time, downstream_kbps and optionally latency, with
+                an optional header row.
+        Times are in seconds and latencies in milliseconds.
+        """
+        with open(path, 'r') as f:
+            text = f.read()
+        if path.endswith('.json'):
+            data = json.loads(text)
+            if isinstance(data, dict):
+                points, period = data['points'], data.get('period')
+            else:
+                points, period = data, None
+            return cls([cls._point(point) for point in points], period=period)
+        points = []
+        for row in csv.reader(text.splitlines()):
+            row = [field.strip() for field in row]
+            if not row or not row[0] or row[0].startswith('#'):
+                continue
+            try:
+                points.append((float(row[0]), float(row[1])) +
+                              tuple(float(field) for field in row[2:3]
+                                    if field))
+            except ValueError:
+                if points:
+                    raise
+                # header
+        return cls(points)
+
+    @staticmethod
+    def _point(point):
+        if isinstance(point, dict):
+            return (point['time'], point['downstream_kbps'],
+                    point.get('latency'))
+        return tuple(point)
+
+
+class TraceShaper(object):
+    """
+    Replays a BandwidthTrace on a proxy from a background thread, by calling
+    `proxy.limits` each time the trace changes, and records when each
+    change was applied.
+
+    Times are read from `clock`; use the clock of the puppeteers whose
+    playback is measured so that limits and playback samples line up.
+
+    Inputs:
+        proxy - A BrowserMob proxy client or ThrottlingServer.
+        trace - The BandwidthTrace to replay.
+        clock - Object with a `now` property in seconds.
+    """
+    def __init__(self, proxy, trace, clock):
+        self.proxy = proxy
+        self.trace = trace
+        self.clock = clock
+        self.start_time = None
+        # list of (wall time, TracePoint), in the order applied
+        self.applied = []
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        """ Apply the start of the trace and replay the rest in a thread. """
+        self._stop.clear()
+        self.start_time = self.clock.now
+        self.apply(self.trace.at(0))
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """ Stop replaying; the limits last applied stay in effect. """
+        self._stop.set()
+        if self._thread:
+            self._thread.join()
+            self._thread = None
+
+    def apply(self, point):
+        self.proxy.limits(point.limits())
+        self.applied.append((self.clock.now, point))
+
+    def _run(self):
+        while not self._stop.is_set():
+            elapsed = self.clock.now - self.start_time
+            change = self.trace.next_change(elapsed)
+            if change is None:
+                return
+            self._stop.wait(max(change - elapsed, 0))
+            if self._stop.is_set():
+                return
+            self.apply(self.trace.at(self.clock.now - self.start_time))
+
+    def limits_at(self, wall_time):
+        """
+        Return the TracePoint that was in effect at `wall_time`, or None
+        if none had been applied yet.
+        """
+        index = bisect_right([t for t, _ in self.applied], wall_time)
+        if index:
+            return self.applied[index - 1][1]
+
+    def to_dict(self):
+        return {
+            'trace': self.trace.to_dict(),
+            'start_time': self.start_time,
+            'applied': [dict(point._asdict(), wall_time=wall_time)
+                        for wall_time, point in self.applied],
+        }
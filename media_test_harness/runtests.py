@@ -2,9 +2,15 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
 
+from functools import partial
 from manifestparser import read_ini
+import json
 import os
+import shutil
+import socket
+import subprocess
 import sys
+import tempfile
 
 from marionette import BaseMarionetteTestRunner, BaseMarionetteArguments
 from marionette.runner import BrowserMobProxyArguments
@@ -12,6 +18,7 @@ from marionette.runtests import MarionetteHarness, cli as mn_cli
 import mozlog
 
 import firefox_media_tests
+import scheduler
 from testcase import MediaTestCase
 from media_utils.video_puppeteer import debug_script
 
@@ -23,15 +30,127 @@ class MediaTestArgumentsBase(object):
             'help': 'ini file of urls to make available to all tests',
             'default': os.path.join(firefox_media_tests.urls, 'default.ini'),
         }],
+        [['--event-driven'], {
+            'action': 'store_true',
+            'default': False,
+            'help': 'wait for playback to start and finish with in-page '
+                    'media events instead of polling the video element',
+        }],
+        [['--tabs'], {
+            'type': int,
+            'default': 1,
+            'help': 'number of tabs in which to play video urls concurrently '
+                    'within one browser session',
+        }],
+        [['--workers'], {
+            'type': int,
+            'default': 1,
+            'help': 'number of Firefox instances, each with its own profile '
+                    'and Marionette port, across which to spread video urls',
+        }],
+        [['--url-tests-only'], {
+            'action': 'store_true',
+            'default': False,
+            'help': 'only run tests that play the video urls; set by '
+                    '--workers for all workers but the first, so that other '
+                    'tests run once',
+        }],
+        [['--schedule'], {
+            'choices': ['file', 'longest-first'],
+            'default': 'file',
+            'help': 'order in which to play video urls: as listed in the '
+                    '--urls file, or longest known duration first',
+        }],
+        [['--local-throttle'], {
+            'action': 'store_true',
+            'default': False,
+            'help': 'in bandwidth tests, serve video urls relative to '
+                    'firefox_media_tests/resources from a built-in '
+                    'throttling server instead of using a BrowserMob proxy',
+        }],
+        [['--bandwidth-trace'], {
+            'default': None,
+            'help': 'JSON or CSV file of downstream bandwidth (kbps) and '
+                    'latency (ms) over time (s) to replay in bandwidth '
+                    'trace tests',
+        }],
+        [['--search-range'], {
+            'type': float,
+            'nargs': 2,
+            'metavar': ('LOW', 'HIGH'),
+            'default': None,
+            'help': 'downstream bandwidths (kbps) between which minimum '
+                    'bandwidth tests search; default 100 2000',
+        }],
+        [['--search-precision'], {
+            'type': float,
+            'default': None,
+            'help': 'kbps to within which minimum bandwidth tests find the '
+                    'lowest bandwidth that plays well; default 50',
+        }],
+        [['--playback-rate'], {
+            'type': float,
+            'default': 1,
+            'help': 'playbackRate at which full-playback tests play videos',
+        }],
+        [['--max-stalls'], {
+            'type': int,
+            'default': None,
+            'help': 'fail playback tests in which a video stalls more often',
+        }],
+        [['--max-stall-duration'], {
+            'type': float,
+            'default': None,
+            'help': 'fail playback tests in which a video stalls for longer '
+                    '(in seconds) at once',
+        }],
+        [['--max-rebuffer-ratio'], {
+            'type': float,
+            'default': None,
+            'help': 'fail playback tests in which a video spends a larger '
+                    'fraction of its playback time stalled',
+        }],
+        [['--debug-interval'], {
+            'type': float,
+            'default': 0,
+            'help': 'capture mozDebugReaderData during playback at most '
+                    'this often (in seconds) and save its changes with the '
+                    'playback metrics; 0 disables capture',
+        }],
+        [['--resource-interval'], {
+            'type': float,
+            'default': 0,
+            'help': 'collect media fetch timings from the resource timing '
+                    'entries of the page at most this often (in seconds) and '
+                    'save the throughput delivered with the playback '
+                    'metrics; 0 disables collection, except in bandwidth '
+                    'tests, which collect every 5 seconds by default',
+        }],
+        [['--url-durations'], {
+            'default': None,
+            'help': 'JSON file of video durations used to schedule urls; '
+                    'durations observed during the run are recorded in it',
+        }],
     ]
 
     def verify_usage_handler(self, args):
+        if args.workers > 1 and not args.binary:
+            raise ValueError('--workers requires --binary')
+        if args.bandwidth_trace and not os.path.isfile(args.bandwidth_trace):
+            raise ValueError('--bandwidth-trace must provide a path to a '
+                             'JSON or CSV file')
         if args.urls:
            if not os.path.isfile(args.urls):
                raise ValueError('--urls must provide a path to an ini file')
            else:
                path = os.path.abspath(args.urls)
                args.video_urls = MediaTestArgumentsBase.get_urls(path)
+               args.video_durations = scheduler.read_manifest_durations(path)
+               args.video_durations.update(
+                   scheduler.read_recorded_durations(args.url_durations))
+               if args.schedule == 'longest-first':
+                   args.video_urls = scheduler.longest_first(
+                       args.video_urls, args.video_durations)
 
     def parse_args_handler(self, args):
         if not args.tests:
@@ -45,14 +164,36 @@ class MediaTestArgumentsBase(object):
 
 
 class MediaTestArguments(BaseMarionetteArguments):
-    def __init__(self, **kwargs):
+    def __init__(self, command_line=None, **kwargs):
+        # arguments parsed when none are given, sys.argv[1:] by default
+        self.command_line = command_line
         BaseMarionetteArguments.__init__(self, **kwargs)
         self.register_argument_container(MediaTestArgumentsBase())
         self.register_argument_container(BrowserMobProxyArguments())
 
+    def parse_args(self, args=None, values=None):
+        """
+        Parse `args` as BaseMarionetteArguments does, and keep them in the
+        `command_line` of the result, from which --workers builds the command
+        lines of its child harnesses.
+        """
+        if args is None:
+            args = (sys.argv[1:] if self.command_line is None
+                    else self.command_line)
+        parsed = BaseMarionetteArguments.parse_args(self, args, values)
+        parsed.command_line = list(args)
+        return parsed
+
 
 class MediaTestRunner(BaseMarionetteTestRunner):
     def __init__(self, **kwargs):
+        self.workers = kwargs.pop('workers', 1)
+        self.command_line = kwargs.pop('command_line', None)
+        if self.command_line is None:
+            self.command_line = sys.argv[1:]
+        self.video_urls = kwargs.get('video_urls') or []
+        self.video_durations = kwargs.get('video_durations') or {}
+        self.url_durations = kwargs.get('url_durations')
         BaseMarionetteTestRunner.__init__(self, **kwargs)
         if not self.server_root:
             self.server_root = firefox_media_tests.resources
@@ -67,15 +208,30 @@ class MediaTestRunner(BaseMarionetteTestRunner):
 
             if marionette.session is not None:
                 try:
-                    with marionette.using_context(marionette.CONTEXT_CHROME):
-                        debug_lines = marionette.execute_script(debug_script)
-                        if debug_lines:
-                            name = 'mozMediaSourceObject.mozDebugReaderData'
-                            rv[name] = '\n'.join(debug_lines)
-                        else:
+                    debug_lines = None
+                    video = getattr(test, 'current_video', None)
+                    if video and video.video:
+                        # only query the element under test, unless it is
+                        # gone
+                        try:
+                            debug_lines = video.get_debug_lines()
+                        except Exception:
                             logger = mozlog.get_default_logger()
-                            logger.info('No data available about '
-                                        'mozMediaSourceObject')
+                            logger.info('Failed to query the video element '
+                                        'under test', exc_info=True)
+                            video = None
+                    if not (video and video.video):
+                        with marionette.using_context(
+                                marionette.CONTEXT_CHROME):
+                            debug_lines = marionette.execute_script(
+                                debug_script)
+                    if debug_lines:
+                        name = 'mozMediaSourceObject.mozDebugReaderData'
+                        rv[name] = '\n'.join(debug_lines)
+                    else:
+                        logger = mozlog.get_default_logger()
+                        logger.info('No data available about '
+                                    'mozMediaSourceObject')
                 except:
                     logger = mozlog.get_default_logger()
                     logger.warning('Failed to gather test failure media debug',
@@ -84,14 +240,196 @@ class MediaTestRunner(BaseMarionetteTestRunner):
 
         self.result_callbacks.append(gather_media_debug)
 
+    def run_tests(self, tests):
+        if self.workers > 1:
+            return self.run_workers()
+        return BaseMarionetteTestRunner.run_tests(self, tests)
+
+    def run_workers(self):
+        """
+        Spread self.video_urls across self.workers child harness processes,
+        balanced by known durations, each running all tests in its own
+        Firefox instance, and merge their structured logs into this runner's
+        logger. Tests that do not play the urls run in the first worker only.
+
+        The workers' files are removed once merged; the output of a worker
+        that failed is logged first.
+        """
+        shards = scheduler.partition(self.video_urls, self.video_durations,
+                                     self.workers)
+        workspace = tempfile.mkdtemp(prefix='media-workers-')
+        self.logger.info('Running %s workers' % len(shards))
+        workers = []
+        try:
+            for index, urls in enumerate(shards):
+                workers.append(self.start_worker(index, urls, workspace))
+            logs = []
+            for index, (process, log_path) in enumerate(workers):
+                process.wait()
+                if process.returncode:
+                    self.logger.warning('Worker %s exited with %s:\n%s' %
+                                        (index, process.returncode,
+                                         self.read_worker_output(workspace,
+                                                                 index)))
+                logs.append((process.returncode,
+                             self.read_worker_log(log_path)))
+            if self.url_durations:
+                scheduler.merge_recorded_durations(
+                    self.url_durations,
+                    [self.worker_durations_path(workspace, index)
+                     for index in range(len(workers))])
+        finally:
+            for process, _ in workers:
+                if process.poll() is None:
+                    process.kill()
+                    process.wait()
+            shutil.rmtree(workspace, ignore_errors=True)
+        tests = []
+        for _, entries in logs:
+            for data in entries:
+                if data.get('action') == 'suite_start':
+                    tests.extend(t for t in data.get('tests', [])
+                                 if t not in tests)
+        self.logger.suite_start(tests)
+        self.failed = 0
+        for returncode, entries in logs:
+            unexpected = self.replay_worker_log(entries)
+            # a worker that failed without reporting why probably crashed
+            if returncode and not unexpected:
+                unexpected = 1
+            self.failed += unexpected
+        self.logger.suite_end()
+
+    def start_worker(self, index, urls, workspace):
+        """
+        Launch a child harness with its own Marionette port, url manifest
+        and raw log file. With --url-durations, the worker records durations
+        in a file of its own, merged by run_workers once all workers exit.
+
+        :return: (Popen instance, path to raw structured log)
+        """
+        urls_path = os.path.join(workspace, 'worker-%s-urls.ini' % index)
+        with open(urls_path, 'w') as f:
+            f.writelines('[%s]\n' % url for url in urls)
+        log_path = os.path.join(workspace, 'worker-%s.log' % index)
+        args = strip_options(self.command_line,
+                             ['--workers', '--urls', '--address', '--log-',
+                              '--url-durations', '--url-tests-only'])
+        args += ['--urls', urls_path,
+                 '--address', 'localhost:%s' % free_port(),
+                 '--log-raw', log_path]
+        if self.url_durations:
+            args += ['--url-durations',
+                     self.worker_durations_path(workspace, index)]
+        if index:
+            args.append('--url-tests-only')
+        output = open(self.worker_output_path(workspace, index), 'w')
+        process = subprocess.Popen(
+            [sys.executable, '-c', 'from media_test_harness import cli; cli()']
+            + args, stdout=output, stderr=subprocess.STDOUT)
+        output.close()
+        return process, log_path
+
+    @staticmethod
+    def worker_durations_path(workspace, index):
+        return os.path.join(workspace, 'worker-%s-durations.json' % index)
+
+    @staticmethod
+    def worker_output_path(workspace, index):
+        return os.path.join(workspace, 'worker-%s.out' % index)
+
+    @classmethod
+    def read_worker_output(cls, workspace, index, lines=50):
+        """
+        Return the last `lines` lines of a worker's stdout and stderr.
+        """
+        path = cls.worker_output_path(workspace, index)
+        if not os.path.exists(path):
+            return ''
+        with open(path) as f:
+            return ''.join(f.readlines()[-lines:])
+
+    @staticmethod
+    def read_worker_log(log_path):
+        """
+        Return the entries of a worker's raw structured log as dicts.
+        """
+        entries = []
+        if not os.path.exists(log_path):
+            return entries
+        with open(log_path) as f:
+            for line in f:
+                try:
+                    entries.append(json.loads(line))
+                except ValueError:
+                    continue
+        return entries
+
+    def replay_worker_log(self, entries):
+        """
+        Replay a worker's structured log entries through self.logger, except
+        suite_start and suite_end, which are logged once for all workers.
+
+        :return: number of unexpected test results in the log
+        """
+        unexpected = 0
+        for data in entries:
+            action = data.get('action')
+            if action in ('suite_start', 'suite_end'):
+                continue
+            if action in ('test_end', 'test_status') and 'expected' in data:
+                unexpected += 1
+            self.logger.log_raw(data)
+        return unexpected
+
+
+def free_port():
+    """
+    Return a TCP port on localhost that is not in use right now.
+    """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    try:
+        sock.bind(('localhost', 0))
+        return sock.getsockname()[1]
+    finally:
+        sock.close()
+
+
+def strip_options(args, names):
+    """
+    Return a copy of command line `args` without the options in `names`, or
+    their values. A name ending in '-' matches every option with that
+    prefix, e.g. '--log-'.
+    """
+    flags = ('-verbose', '-nocolor', '--url-tests-only')
+    stripped = []
+    skip_value = False
+    for arg in args:
+        if skip_value:
+            skip_value = False
+            continue
+        name = arg.split('=', 1)[0]
+        if any(name == n or (n.endswith('-') and name.startswith(n))
+               for n in names):
+            skip_value = '=' not in arg and not name.endswith(flags)
+            continue
+        stripped.append(arg)
+    return stripped
+
 
 class FirefoxMediaHarness(MarionetteHarness):
     def parse_args(self, *args, **kwargs):
         return MarionetteHarness.parse_args(self, {'mach': sys.stdout})
 
 
-def cli():
-    mn_cli(MediaTestRunner, MediaTestArguments, FirefoxMediaHarness)
+def cli(args=None):
+    """
+    Run the harness.
+
+    :param args: command line arguments to parse instead of sys.argv[1:]
+    """
+    mn_cli(MediaTestRunner, partial(MediaTestArguments, command_line=args),
+           FirefoxMediaHarness)
 
 if __name__ == '__main__':
     cli()
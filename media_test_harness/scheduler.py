@@ -0,0 +1,123 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import json
+import os
+import re
+
+_time_comment = re.compile(r'^#\s*(?:(\d+):)?(\d+):(\d\d)\s*$')
+_section = re.compile(r'^\[(.+)\]\s*$')
+_duration_key = re.compile(r'^duration\s*[=:]\s*(.+)$')
+
+
+def parse_duration(text):
+    """
+    Return seconds for `text` in the form seconds, mm:ss or h:mm:ss, or None.
+    """
+    try:
+        seconds = 0
+        for part in text.strip().split(':'):
+            seconds = seconds * 60 + float(part)
+        return seconds
+    except ValueError:
+        return None
+
+
+def read_manifest_durations(manifest):
+    """
+    Return a dict of url to duration in seconds, for the urls in `manifest`
+    that have a `duration` key or a duration comment.
+    """
+    durations = {}
+    comment_duration = None
+    url = None
+    with open(manifest, 'r') as f:
+        for line in f:
+            line = line.strip()
+            match = _time_comment.match(line)
+            if match:
+                hours, minutes, seconds = match.groups()
+                comment_duration = (int(hours or 0) * 3600 +
+                                    int(minutes) * 60 + int(seconds))
+                continue
+            match = _section.match(line)
+            if match:
+                url = match.group(1).strip()
+                if comment_duration is not None:
+                    durations[url] = comment_duration
+                comment_duration = None
+                continue
+            match = _duration_key.match(line)
+            if match and url:
+                duration = parse_duration(match.group(1))
+                if duration is not None:
+                    durations[url] = duration
+            comment_duration = None
+    return durations
+
+
+def read_recorded_durations(path):
+    """
+    Return the dict of url to duration stored at `path` by record_duration,
+    or an empty dict if there is no such file.
+    """
+    if not path or not os.path.isfile(path):
+        return {}
+    with open(path, 'r') as f:
+        try:
+            return json.load(f)
+        except ValueError:
+            return {}
+
+
+def record_duration(path, url, duration):
+    """
+    Store `duration` (in seconds) of `url` in the JSON file at `path`.
+    """
+    durations = read_recorded_durations(path)
+    durations[url] = duration
+    with open(path, 'w') as f:
+        json.dump(durations, f, indent=2, sort_keys=True)
+
+
+def merge_recorded_durations(path, sources):
+    """
+    Store the durations recorded in each of the files at `sources`, such as
+    those of worker processes, in the file at `path`. Files are not locked,
+    so each process must record into a file of its own.
+    """
+    durations = read_recorded_durations(path)
+    for source in sources:
+        durations.update(read_recorded_durations(source))
+    with open(path, 'w') as f:
+        json.dump(durations, f, indent=2, sort_keys=True)
+
+
+def longest_first(urls, durations):
+    """
+    Return `urls` with urls of known duration first, longest first, followed
+    by the remaining urls in their original order.
+    """
+    known = [url for url in urls if url in durations]
+    unknown = [url for url in urls if url not in durations]
+    # sorted is stable, so urls of equal duration keep their file order
+    return sorted(known, key=lambda url: -durations[url]) + unknown
+
+
+def partition(urls, durations, bins):
+    """
+    Split `urls` into at most `bins` non-empty lists of roughly equal total
+    duration, assigning the longest urls first to the least loaded list.
+    Urls of unknown duration are counted as the mean known duration and are
+    assigned afterwards in their original order.
+    """
+    known = [durations[url] for url in urls if url in durations]
+    default = float(sum(known)) / len(known) if known else 1
+    loads = [0] * bins
+    shards = [[] for _ in range(bins)]
+    for url in longest_first(urls, durations):
+        index = loads.index(min(loads))
+        shards[index].append(url)
+        loads[index] += durations.get(url, default)
+    return [shard for shard in shards if shard]
@@ -2,7 +2,10 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
 
+from collections import OrderedDict
 import os
+import re
+import unittest
 
 from marionette import BrowserMobProxyTestCaseMixin
 from marionette_driver import Wait
@@ -10,17 +13,75 @@ from marionette_driver.errors import TimeoutException
 from marionette.marionette_test import SkipTest
 
 from firefox_puppeteer.testcases import FirefoxTestCase
+import firefox_media_tests
 from firefox_media_tests.utils import (timestamp_now, verbose_until)
-from media_utils.video_puppeteer import (playback_done, playback_started,
-                                         VideoException, VideoPuppeteer as VP)
+from media_test_harness.bandwidth_search import search_min_bandwidth
+from media_test_harness.bandwidth_trace import BandwidthTrace, TraceShaper
+from media_test_harness.scheduler import record_duration
+from media_test_harness.throttling_server import ThrottlingServer
+from media_utils.timing import MonotonicClock
+from media_utils.video_puppeteer import (debug_script, playback_done,
+                                         playback_started, VideoException,
+                                         VideoPuppeteer as VP)
 
 
 class MediaTestCase(FirefoxTestCase):
 
+    # Tests that do not play self.video_urls set this to False, so that
+    # --workers runs them in one worker only.
+    uses_video_urls = True
+
     def __init__(self, *args, **kwargs):
         self.video_urls = kwargs.pop('video_urls', False)
+        self.event_driven = kwargs.pop('event_driven', False)
+        self.tabs = kwargs.pop('tabs', 1)
+        self.url_durations = kwargs.pop('url_durations', None)
+        self.playback_rate = kwargs.pop('playback_rate', 1)
+        self.debug_interval = kwargs.pop('debug_interval', 0)
+        self.resource_interval = kwargs.pop('resource_interval', 0)
+        # puppeteer of the video being played, for failure diagnostics
+        self.current_video = None
+        # added to the names of metrics files, to tell apart the playbacks
+        # of a url within one test, such as at different bandwidths
+        self.metrics_label = None
+        self.qoe_thresholds = {
+            'max_stalls': kwargs.pop('max_stalls', None),
+            'max_stall_duration': kwargs.pop('max_stall_duration', None),
+            'max_rebuffer_ratio': kwargs.pop('max_rebuffer_ratio', None),
+        }
+        # shared with the puppeteers created by run_playbacks
+        self.clock = MonotonicClock()
         FirefoxTestCase.__init__(self, *args, **kwargs)
 
+    @classmethod
+    def add_tests_to_suite(cls, mod_name, filepath, suite, testloader,
+                           marionette, testvars, **kwargs):
+        """
+        Add the tests in `filepath` to `suite`, except, with
+        url_tests_only, those that do not play the video urls.
+        """
+        url_tests_only = kwargs.pop('url_tests_only', False)
+        tests = unittest.TestSuite()
+        super(MediaTestCase, cls).add_tests_to_suite(
+            mod_name, filepath, tests, testloader, marionette, testvars,
+            **kwargs)
+        for test in tests:
+            if not url_tests_only or getattr(test, 'uses_video_urls', False):
+                suite.addTest(test)
+
+    def setUp(self):
+        FirefoxTestCase.setUp(self)
+        if self.tabs > 1:
+            self.allow_background_playback()
+
+    def allow_background_playback(self):
+        with self.marionette.using_context('chrome'):
+            # Videos in background tabs must keep playing and decoding
+            self.prefs.set_pref('media.block-autoplay-until-in-foreground',
+                                False)
+            self.prefs.set_pref('media.suspend-bkgnd-video.enabled',
+                                False)
+
     def save_screenshot(self):
         screenshot_dir = os.path.join(self.marionette.instance.workspace or '',
                                       'screenshots')
@@ -37,32 +98,274 @@ class MediaTestCase(FirefoxTestCase):
             f.write(img_data.decode('base64'))
         self.marionette.log('Screenshot saved in %s' % os.path.abspath(path))
 
-    def log_video_debug_lines(self):
-        with self.marionette.using_context('chrome'):
-            debug_lines = self.marionette.execute_script(VP._debug_script)
-            if debug_lines:
-                self.marionette.log('\n'.join(debug_lines))
+    def save_metrics(self, video):
+        """
+        Save the playback metrics recorded by `video` as JSON and CSV in the
+        'metrics' directory of the workspace, along with its captures of
+        mozDebugReaderData, if any.
+        """
+        if not len(video.metrics):
+            return
+        # instance is None when Firefox was not launched by the harness
+        workspace = getattr(self.marionette.instance, 'workspace', None)
+        metrics_dir = os.path.join(workspace or '', 'metrics')
+        if not os.path.exists(metrics_dir):
+            os.makedirs(metrics_dir)
+        name = '_'.join([self.id().replace(' ', '-'),
+                         re.sub(r'[^\w.-]+', '-', video.test_url)] +
+                        ([self.metrics_label] if self.metrics_label else []))
+        path = os.path.join(metrics_dir, name)
+        video.metrics.to_json(path + '.json')
+        video.metrics.to_csv(path + '.csv')
+        self.marionette.log('Metrics saved in %s.{json,csv}' %
+                            os.path.abspath(path))
+        if len(video.debug_log):
+            video.debug_log.to_json(path + '.debug.json')
+
+    def log_startup_timing(self, video):
+        """ Log how long `video` took to show its first frame and to start.
+        """
+        self.logger.info('Time to first frame: %s s, startup latency: %s s' %
+                         (video.marks.time_to_first_frame,
+                          video.marks.startup_latency))
+
+    def check_qoe(self, video):
+        """
+        Log the QoE metrics of `video` and return a failure message if they
+        exceed self.qoe_thresholds, or None.
+        """
+        summary = video.qoe.summary()
+        self.logger.info('%s stalls (%s s in total), rebuffer ratio %.3f' %
+                         (summary['stall_count'],
+                          summary['total_stall_time'],
+                          summary['rebuffer_ratio']))
+        if len(video.resources):
+            self.log_stall_fetches(video)
+        self.log_quality_switches(video)
+        violations = video.qoe.violations(**self.qoe_thresholds)
+        if violations:
+            return 'Poor playback of %s: %s\n%s' % (
+                video.test_url, ', '.join(violations), video)
+
+    def log_quality_switches(self, video):
+        """
+        Log every quality switch of `video` and a summary of its ABR metrics.
+        """
+        for switch in video.abr.switches:
+            self.logger.info('Quality %s -> %s at %.1f s with %.1f s '
+                             'buffered, %s/%s frames dropped before/after' %
+                             (switch.old, switch.new, switch.media_time,
+                              switch.buffer_level, switch.dropped_before,
+                              switch.dropped_after))
+        summary = video.abr.summary()
+        self.logger.info('%s quality switches (%.2f per minute, %s up), '
+                         'seconds at each quality: %s' %
+                         (summary['switch_count'],
+                          summary['switches_per_minute'],
+                          summary['upswitch_count'],
+                          ', '.join('%s: %.1f' % item for item
+                                    in video.abr.time_at_level.items())))
+
+    def log_stall_fetches(self, video):
+        """
+        Log the throughput delivered to `video` during each of its stalls
+        and how much of that time it was fetching media, which tells a
+        starved network (fetching, little delivered) apart from slow
+        decoding or a player that did not ask for data (not fetching).
+        """
+        for stall in video.qoe.stalls:
+            end = stall.end or video.clock.now
+            self.logger.info('Stall at %.1f s for %.1f s: %.0f kbps '
+                             'delivered, fetching %.0f%% of the time' %
+                             (stall.media_time, end - stall.start,
+                              video.resources.throughput(stall.start, end)
+                              or 0,
+                              (video.resources.busy(stall.start, end)
+                               or 0) * 100))
+
+    def log_video_debug_lines(self, video=None):
+        """
+        Log mozDebugReaderData of `video`, or of the first video with a
+        MediaSource in any tab if `video` is None.
+        """
+        if video:
+            debug_lines = video.get_debug_lines()
+        else:
+            with self.marionette.using_context('chrome'):
+                debug_lines = self.marionette.execute_script(debug_script)
+        if debug_lines:
+            self.marionette.log('\n'.join(debug_lines))
 
     def run_playback(self, video):
+        self.current_video = video
         with self.marionette.using_context('content'):
             self.logger.info(video.test_url)
+            self.log_startup_timing(video)
+            timeout = (video.max_wall_duration * 1.3 +
+                       video.stall_wait_time)
             try:
-                verbose_until(Wait(video, interval=video.interval,
-                                   timeout=video.expected_duration * 1.3 +
-                                   video.stall_wait_time),
-                              video, playback_done)
+                if self.event_driven:
+                    summary = video.wait_for_playback_end(timeout)
+                    self.logger.info('Playback finished (%s) at %s s after '
+                                     '%s s' % (summary.reason,
+                                               summary.current_time,
+                                               summary.elapsed))
+                else:
+                    verbose_until(Wait(video, interval=video.interval,
+                                       timeout=timeout, clock=video.clock),
+                                  video, playback_done)
             except VideoException as e:
                 raise self.failureException(e)
+            finally:
+                self.save_metrics(video)
+            self.record_video_duration(video)
+            failure = self.check_qoe(video)
+            if failure:
+                raise self.failureException(failure)
+
+    def record_video_duration(self, video):
+        """
+        Record the duration of `video` in self.url_durations, if set, for
+        scheduling later runs.
+        """
+        if self.url_durations:
+            record_duration(self.url_durations, video.test_url,
+                            video.duration)
 
     def check_playback_starts(self, video):
+        self.current_video = video
         with self.marionette.using_context('content'):
             self.logger.info(video.test_url)
             try:
-                verbose_until(Wait(video, timeout=video.timeout),
-                              video, playback_started)
+                if self.event_driven:
+                    video.wait_for_playback_start()
+                else:
+                    verbose_until(Wait(video, timeout=video.timeout,
+                                       clock=video.clock),
+                                  video, playback_started)
             except TimeoutException as e:
                 raise self.failureException(e)
 
+    def run_playbacks(self, urls, puppeteer=VP, **kwargs):
+        """
+        Play each of `urls` with run_playback, in up to self.tabs tabs at once.
+
+        :param urls: urls of pages containing a video element
+        :param puppeteer: VideoPuppeteer class to create for each url
+        :param kwargs: passed on to `puppeteer` along with each url
+        """
+        kwargs.setdefault('clock', self.clock)
+        kwargs.setdefault('debug_interval', self.debug_interval)
+        kwargs.setdefault('resource_interval', self.resource_interval)
+        if self.tabs > 1:
+            self.run_playbacks_in_tabs(urls, puppeteer=puppeteer, **kwargs)
+            return
+        with self.marionette.using_context('content'):
+            for url in urls:
+                # so that a failure to start is not blamed on the last video
+                self.current_video = None
+                video = puppeteer(self.marionette, url, **kwargs)
+                self.run_playback(video)
+
+    def run_playbacks_in_tabs(self, urls, puppeteer=VP, **kwargs):
+        """
+        Play `urls` concurrently, each in its own tab, with at most self.tabs
+        tabs open at once, as in play_in_tabs.
+
+        Failures are reported together once all urls have been played.
+
+        :return: dict of url to failure message, or None if it played well
+        """
+        results = self.play_in_tabs(urls, self.tabs, puppeteer=puppeteer,
+                                    **kwargs)
+        failures = ['%s: %s' % (url, results[url]) for url in urls
+                    if results.get(url)]
+        if failures:
+            raise self.failureException('\n'.join(
+                ['%s of %s videos failed:' % (len(failures), len(urls))] +
+                failures))
+        return results
+
+    def play_in_tabs(self, urls, max_tabs, puppeteer=VP, **kwargs):
+        """
+        Play `urls` concurrently, each in its own tab, with at most
+        `max_tabs` tabs open at once. Playback is polled with playback_done
+        in turn across tabs, regardless of self.event_driven. Tabs are
+        started one per round of polling, since starting a puppeteer blocks
+        until its video plays, and videos that went past their end between
+        polls count as done.
+
+        Failures are logged per url as they happen.
+
+        :return: dict of url to failure message, or None if it played well
+        """
+        # videos are in tabs that may be closed by the time a failure is
+        # reported
+        self.current_video = None
+        results = {}
+        pending = list(urls)
+        # tab handle -> (tab, url, video, deadline)
+        active = {}
+        first_tab = self.browser.tabbar.tabs[0]
+        tabs = [first_tab]
+        try:
+            while len(tabs) < min(max_tabs, len(pending)):
+                tabs.append(self.browser.tabbar.open_tab())
+            idle = list(tabs)
+            while pending or active:
+                started = False
+                if pending and idle:
+                    started = True
+                    tab = idle.pop(0)
+                    url = pending.pop(0)
+                    tab.switch_to()
+                    self.logger.info('%s (tab %s)' % (url, tab.handle))
+                    try:
+                        with self.marionette.using_context('content'):
+                            video = puppeteer(self.marionette, url, **kwargs)
+                    except (TimeoutException, VideoException) as e:
+                        results[url] = str(e)
+                        self.logger.error('%s failed to start: %s' % (url, e))
+                        idle.append(tab)
+                        continue
+                    self.log_startup_timing(video)
+                    deadline = (self.clock.now +
+                                video.max_wall_duration * 1.3 +
+                                video.stall_wait_time)
+                    active[tab.handle] = (tab, url, video, deadline)
+                for handle, (tab, url, video, deadline) in list(
+                        active.items()):
+                    self.marionette.switch_to_window(handle)
+                    try:
+                        with self.marionette.using_context('content'):
+                            if playback_done(video, past_end=True):
+                                self.record_video_duration(video)
+                                results[url] = self.check_qoe(video)
+                            elif self.clock.now > deadline:
+                                results[url] = ('Playback timed out\n%s' %
+                                                video)
+                            else:
+                                continue
+                    except VideoException as e:
+                        results[url] = str(e)
+                    self.save_metrics(video)
+                    if results[url]:
+                        self.logger.error('%s failed: %s' %
+                                          (url, results[url]))
+                    else:
+                        self.logger.info('%s played' % url)
+                    del active[handle]
+                    idle.append(tab)
+                if active and not started:
+                    self.clock.sleep(min(video.interval
+                                         for _, _, video, _ in
+                                         active.values()))
+        finally:
+            for tab in tabs[1:]:
+                tab.close()
+            first_tab.switch_to()
+        return results
+
     def skipTest(self, reason):
         """
         Skip this test.
@@ -74,30 +377,216 @@ class MediaTestCase(FirefoxTestCase):
 
 
 class NetworkBandwidthTestCase(MediaTestCase):
+    """
+    Plays videos through a proxy whose bandwidth is limited with
+    `self.proxy.limits`.
+
+    By default the proxy is a BrowserMob proxy. With --local-throttle, it is
+    instead a ThrottlingServer serving firefox_media_tests/resources, and
+    video urls are paths relative to that directory.
+
+    With --bandwidth-trace, self.bandwidth_trace is the BandwidthTrace read
+    from that file, for run_videos_with_trace.
+
+    --search-range and --search-precision set the defaults of
+    search_min_bandwidth.
+    """
 
     def __init__(self, *args, **kwargs):
+        self.local_throttle = kwargs.get('local_throttle', False)
+        trace_path = kwargs.get('bandwidth_trace')
+        self.bandwidth_trace = (BandwidthTrace.from_file(trace_path)
+                                if trace_path else None)
+        self.search_range = kwargs.get('search_range') or (100, 2000)
+        self.search_precision = kwargs.get('search_precision') or 50
         MediaTestCase.__init__(self, *args, **kwargs)
         BrowserMobProxyTestCaseMixin.__init__(self, *args, **kwargs)
+        # bandwidth tests always measure the throughput delivered
+        self.resource_interval = self.resource_interval or 5
         self.proxy = None
+        # TraceShaper replaying a trace on self.proxy, if any
+        self.shaper = None
 
     def setUp(self):
         MediaTestCase.setUp(self)
-        BrowserMobProxyTestCaseMixin.setUp(self)
-        self.proxy = self.create_browsermob_proxy()
+        if self.local_throttle:
+            self.proxy = ThrottlingServer(firefox_media_tests.resources)
+            self.proxy.start()
+        else:
+            BrowserMobProxyTestCaseMixin.setUp(self)
+            self.proxy = self.create_browsermob_proxy()
 
     def tearDown(self):
         MediaTestCase.tearDown(self)
-        BrowserMobProxyTestCaseMixin.tearDown(self)
+        if self.local_throttle:
+            self.proxy.stop()
+        else:
+            BrowserMobProxyTestCaseMixin.tearDown(self)
         self.proxy = None
 
+    def media_urls(self):
+        """
+        Return self.video_urls, resolved against the throttling server when
+        running with --local-throttle.
+        """
+        if self.local_throttle:
+            return [self.proxy.absolute_url(url) for url in self.video_urls]
+        return self.video_urls
 
-    def run_videos(self):
-        with self.marionette.using_context('content'):
+    def run_videos(self, urls=None):
+        self.run_playbacks(urls or self.media_urls(), stall_wait_time=60,
+                           set_duration=60)
+
+    def run_tiers(self, tiers):
+        """
+        Play videos as in run_videos at each downstream bandwidth in `tiers`
+        (kbps), and report the failures of all tiers together.
+
+        With --local-throttle, all tiers play at once, as in
+        play_tiers_in_tabs. A BrowserMob proxy shapes the whole browser, so
+        its tiers play one after another.
+
+        :return: dict of kbps to list of failure messages
+        """
+        if self.local_throttle:
+            results = self.play_tiers_in_tabs(tiers)
+        else:
+            results = {}
+            for kbps in tiers:
+                self.proxy.limits({'downstream_kbps': kbps})
+                self.logger.info('Playing at %s kbps' % kbps)
+                self.metrics_label = '%gkbps' % kbps
+                try:
+                    self.run_videos()
+                    results[kbps] = []
+                except self.failureException as e:
+                    results[kbps] = [str(e)]
+                finally:
+                    self.metrics_label = None
+        for kbps in tiers:
+            self.logger.info('%s kbps: %s' %
+                             (kbps, 'failed' if results[kbps] else 'passed'))
+        failures = ['%s kbps:\n%s' % (kbps, '\n'.join(results[kbps]))
+                    for kbps in tiers if results[kbps]]
+        if failures:
+            raise self.failureException('\n'.join(
+                ['%s of %s tiers failed:' % (len(failures), len(tiers))] +
+                failures))
+        return results
+
+    def play_tiers_in_tabs(self, tiers):
+        """
+        Play videos at all `tiers` at once, each tier through its own
+        ThrottlingServer, with each video of each tier in its own tab and
+        up to max(self.tabs, len(tiers)) tabs open at once.
+
+        A `kbps` query is added to the urls of each tier, so that their
+        metrics are saved separately.
+
+        :return: dict of kbps to list of failure messages
+        """
+        servers = {}
+        # url -> kbps
+        tier_urls = OrderedDict()
+        try:
+            for kbps in tiers:
+                server = ThrottlingServer(firefox_media_tests.resources)
+                server.start()
+                servers[kbps] = server
+                server.limits({'downstream_kbps': kbps})
             for url in self.video_urls:
-                video = VP(self.marionette, url,
-                                       stall_wait_time=60,
-                                       set_duration=60)
-                self.run_playback(video)
+                for kbps in tiers:
+                    tier_url = servers[kbps].absolute_url(url)
+                    tier_url += '%skbps=%s' % ('&' if '?' in tier_url else '?',
+                                               kbps)
+                    tier_urls[tier_url] = kbps
+            self.allow_background_playback()
+            played = self.play_in_tabs(
+                list(tier_urls), max(self.tabs, len(tiers)),
+                clock=self.clock, debug_interval=self.debug_interval,
+                resource_interval=self.resource_interval,
+                stall_wait_time=60, set_duration=60)
+        finally:
+            for server in servers.values():
+                server.stop()
+        results = dict((kbps, []) for kbps in tiers)
+        for url, kbps in tier_urls.items():
+            if played.get(url):
+                results[kbps].append('%s: %s' % (url, played[url]))
+        return results
+
+    def run_videos_with_trace(self, trace):
+        """
+        Play videos as in run_videos while replaying `trace` on self.proxy.
+
+        The trace restarts with each video, so that all videos start under
+        the same conditions, except with --tabs, where the videos share the
+        proxy and play under a single replay.
+        """
+        batches = ([self.media_urls()] if self.tabs > 1 else
+                   [[url] for url in self.media_urls()])
+        for urls in batches:
+            self.shaper = TraceShaper(self.proxy, trace, self.clock)
+            self.shaper.start()
+            try:
+                self.run_videos(urls)
+            finally:
+                self.shaper.stop()
+                self.shaper = None
+
+    def search_min_bandwidth(self, url, low=None, high=None, precision=None):
+        """
+        Bisect the downstream bandwidth of self.proxy for the lowest rate at
+        which `url` plays as in run_videos without failing, to within
+        `precision` kbps, between `low` and `high` kbps.
+
+        Playback fails if it does not finish or breaks the QoE thresholds,
+        which default to no stalls at all when none is set. The HTTP cache
+        is disabled so that every playback goes through the proxy.
+
+        :return: SearchResult
+        """
+        if low is None or high is None:
+            low, high = self.search_range
+        precision = precision or self.search_precision
+        with self.marionette.using_context('chrome'):
+            self.prefs.set_pref('browser.cache.disk.enable', False)
+            self.prefs.set_pref('browser.cache.memory.enable', False)
+        thresholds = self.qoe_thresholds
+        if all(value is None for value in thresholds.values()):
+            self.qoe_thresholds = dict(thresholds, max_stalls=0)
+
+        def play(kbps):
+            self.proxy.limits({'downstream_kbps': kbps})
+            self.logger.info('Playing %s at %s kbps' % (url, kbps))
+            self.metrics_label = '%gkbps' % kbps
+            try:
+                self.run_videos([url])
+            except (self.failureException, TimeoutException,
+                    VideoException) as e:
+                self.logger.info('Failed at %s kbps: %s' % (kbps, e))
+                return str(e)
+            finally:
+                self.metrics_label = None
+
+        try:
+            result = search_min_bandwidth(play, low, high, precision)
+        finally:
+            self.qoe_thresholds = thresholds
+        if result.min_kbps is None:
+            self.logger.info('%s does not play well at %s kbps' %
+                             (url, high))
+        else:
+            self.logger.info('%s plays well at %s kbps, and not at %s kbps '
+                             '(%s playbacks)' %
+                             (url, result.min_kbps, result.max_failing_kbps,
+                              len(result.probes)))
+        return result
+
+    def save_metrics(self, video):
+        if self.shaper:
+            video.metrics.network = self.shaper
+        MediaTestCase.save_metrics(self, video)
 
 
 class VideoPlaybackTestsMixin(object):
@@ -114,6 +603,7 @@ class VideoPlaybackTestsMixin(object):
     def test_playback_starts(self):
         with self.marionette.using_context('content'):
             for url in self.video_urls:
+                self.current_video = None
                 try:
                     video = VP(self.marionette, url, timeout=60)
                     # Second playback_started check in case video._start_time
@@ -130,9 +620,5 @@ class VideoPlaybackTestsMixin(object):
 
     def test_video_playback_partial(self):
         """ First 60 seconds of video play well. """
-        with self.marionette.using_context('content'):
-            for url in self.video_urls:
-                video = VP(self.marionette, url,
-                           stall_wait_time=10,
+        self.run_playbacks(self.video_urls, stall_wait_time=10,
                            set_duration=60)
-                self.run_playback(video)
@@ -0,0 +1,188 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+from BaseHTTPServer import HTTPServer
+from SimpleHTTPServer import SimpleHTTPRequestHandler
+from SocketServer import ThreadingMixIn
+import os
+import posixpath
+import re
+import threading
+import time
+import urllib
+import urlparse
+
+
+class TokenBucket(object):
+    """
+    Limits the rate at which bytes are sent on one connection.
+
+    Tokens are bytes. They accumulate at the server's current downstream rate
+    up to `burst` and each chunk sent must first take its size in tokens.
+    The rate is read from the server on every call, so changes made with
+    ThrottlingServer.limits apply to connections that are already open.
+    """
+    def __init__(self, server, burst):
+        self.server = server
+        self.burst = burst
+        self.tokens = burst
+        self.last = time.time()
+
+    def consume(self, size):
+        """ Block until `size` bytes may be sent. """
+        while True:
+            rate = self.server.downstream_bytes_per_second
+            now = time.time()
+            if not rate:
+                self.last = now
+                return
+            self.tokens = min(self.burst,
+                              self.tokens + (now - self.last) * rate)
+            self.last = now
+            if self.tokens >= size:
+                self.tokens -= size
+                return
+            time.sleep((size - self.tokens) / rate)
+
+
+class ThrottlingRequestHandler(SimpleHTTPRequestHandler):
+    """
+    Serves files from the server's root, with support for single byte
+    ranges, at the server's bandwidth and latency limits.
+    """
+    protocol_version = 'HTTP/1.1'
+    extensions_map = dict(SimpleHTTPRequestHandler.extensions_map, **{
+        '.mp4': 'video/mp4',
+        '.m4s': 'video/iso.segment',
+        '.webm': 'video/webm',
+        '.ogv': 'video/ogg',
+        '.mpd': 'application/dash+xml',
+    })
+    _range = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+    def translate_path(self, path):
+        path = posixpath.normpath(urllib.unquote(urlparse.urlparse(path).path))
+        parts = [part for part in path.split('/')
+                 if part and part not in (os.curdir, os.pardir)]
+        return os.path.join(self.server.root, *parts)
+
+    def do_GET(self):
+        self.serve(send_body=True)
+
+    def do_HEAD(self):
+        self.serve(send_body=False)
+
+    def serve(self, send_body):
+        latency = self.server.latency
+        if latency:
+            time.sleep(latency)
+        path = self.translate_path(self.path)
+        if not os.path.isfile(path):
+            self.send_error(404, 'File not found')
+            return
+        size = os.path.getsize(path)
+        start, end = 0, size - 1
+        status = 200
+        match = self._range.match(self.headers.get('Range', ''))
+        if match and (match.group(1) or match.group(2)):
+            if match.group(1):
+                start = int(match.group(1))
+                if match.group(2):
+                    end = min(int(match.group(2)), size - 1)
+            else:
+                start = max(0, size - int(match.group(2)))
+            if start > end:
+                self.send_response(416)
+                self.send_header('Content-Range', 'bytes */%s' % size)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            status = 206
+        self.send_response(status)
+        self.send_header('Content-Type', self.guess_type(path))
+        self.send_header('Accept-Ranges', 'bytes')
+        self.send_header('Content-Length', str(end - start + 1))
+        if status == 206:
+            self.send_header('Content-Range',
+                             'bytes %s-%s/%s' % (start, end, size))
+        self.end_headers()
+        if send_body:
+            self.send_range(path, start, end)
+
+    def send_range(self, path, start, end):
+        bucket = TokenBucket(self.server, self.server.chunk_size)
+        remaining = end - start + 1
+        with open(path, 'rb') as f:
+            f.seek(start)
+            while remaining > 0:
+                chunk = f.read(min(self.server.chunk_size, remaining))
+                if not chunk:
+                    break
+                bucket.consume(len(chunk))
+                self.wfile.write(chunk)
+                remaining -= len(chunk)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class ThrottlingServer(ThreadingMixIn, HTTPServer):
+    """
+    Local HTTP server that serves the files in `root` with per-connection
+    bandwidth and latency shaping, in place of a BrowserMob proxy.
+
+    Like a BrowserMob proxy client, it is shaped with `limits`.
+
+    Inputs:
+        root - The directory to serve.
+        host - The address to listen on.
+        port - The port to listen on; 0 picks a free one.
+        chunk_size - The number of bytes written at a time, which is also
+            the largest burst allowed on a connection.
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, root, host='127.0.0.1', port=0, chunk_size=16384):
+        HTTPServer.__init__(self, (host, port), ThrottlingRequestHandler)
+        self.root = os.path.abspath(root)
+        self.chunk_size = chunk_size
+        self.downstream_bytes_per_second = 0
+        self.latency = 0
+        self._thread = None
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    @property
+    def url(self):
+        return 'http://%s:%s/' % self.server_address
+
+    def absolute_url(self, path):
+        return urlparse.urljoin(self.url, path)
+
+    def limits(self, options):
+        """
+        Shape all connections, including open ones.
+
+        :param options: dict that may have 'downstream_kbps' (0: unlimited)
+            and 'latency' in milliseconds, like the options of
+            browsermobproxy.Client.limits.
+        """
+        if 'downstream_kbps' in options:
+            self.downstream_bytes_per_second = (
+                options['downstream_kbps'] * 1000 / 8.0)
+        if 'latency' in options:
+            self.latency = options['latency'] / 1000.0
+
+    def start(self):
+        self._thread = threading.Thread(target=self.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+        self._thread.join()
@@ -0,0 +1,149 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+from collections import namedtuple, OrderedDict
+
+
+class QualitySwitch(namedtuple('QualitySwitch', [
+        'wall_time', 'media_time', 'old', 'new', 'direction', 'buffer_level',
+        'dropped_before', 'dropped_after'])):
+    """
+    One change of quality, as recorded by AbrTracker.
+
+    wall_time, media_time - of the first sample at the new quality; the
+        switch happened since the previous sample.
+    old, new - quality levels, such as '1280x720' or 'hd720'.
+    direction - 1 for an upswitch, -1 for a downswitch, 0 if the levels
+        rank the same.
+    buffer_level - seconds buffered ahead of media_time.
+    dropped_before - frames dropped since the previous sample.
+    dropped_after - frames dropped until the next sample, or None until
+        there is one.
+    """
+    __slots__ = ()
+
+
+class AbrTracker(object):
+    """
+    Follows the quality level of a video through samples, such as
+    VideoPuppeteer snapshots, to record every quality switch and the time
+    spent at each level.
+
+    Each level comes with a rank, such as its height in pixels, that tells
+    upswitches from downswitches. Samples taken while paused, seeking,
+    ended or showing an ad should be passed with paused=True: they are not
+    counted as time at any level and their level is ignored.
+    """
+    def __init__(self):
+        self.switches = []
+        # level -> seconds of playback at that level
+        self.time_at_level = OrderedDict()
+        self.play_time = 0
+        self._level = None
+        self._rank = None
+        self._last = None
+
+    @property
+    def level(self):
+        return self._level
+
+    def add_sample(self, wall_time, media_time, level, rank, buffer_level=0,
+                   dropped_frames=0, paused=False):
+        """
+        Account for the state of the video at `wall_time`.
+
+        :param level: the quality being shown, or None if unknown yet
+        :param rank: orders levels, higher meaning better quality
+        :param dropped_frames: droppedVideoFrames of the element
+        """
+        last, self._last = self._last, (wall_time, dropped_frames)
+        dropped = 0
+        if last is not None:
+            last_wall_time, last_dropped = last
+            # counts start over with a new media resource
+            dropped = max(dropped_frames - last_dropped, 0)
+            if self.switches and self.switches[-1].dropped_after is None:
+                self.switches[-1] = self.switches[-1]._replace(
+                    dropped_after=dropped)
+        if paused or level is None:
+            # the next interval starts with the next sample
+            self._last = (None, dropped_frames)
+            return
+        if last is not None and last[0] is not None and self._level:
+            elapsed = wall_time - last[0]
+            self.play_time += elapsed
+            self.time_at_level[self._level] = (
+                self.time_at_level.get(self._level, 0) + elapsed)
+        if level != self._level:
+            if self._level is not None:
+                direction = ((rank > self._rank) - (rank < self._rank)
+                             if rank is not None and self._rank is not None
+                             else 0)
+                self.switches.append(QualitySwitch(
+                    wall_time, media_time, self._level, level, direction,
+                    buffer_level, dropped, None))
+            self._level = level
+        self._rank = rank
+
+    @property
+    def upswitches(self):
+        return [switch for switch in self.switches if switch.direction > 0]
+
+    @property
+    def downswitches(self):
+        return [switch for switch in self.switches if switch.direction < 0]
+
+    def switches_per_minute(self):
+        if not self.play_time:
+            return 0
+        return len(self.switches) * 60.0 / self.play_time
+
+    def recovery_times(self):
+        """
+        Return, for each downswitch, seconds until the next upswitch, or
+        None if quality did not go up again.
+        """
+        times = []
+        for index, switch in enumerate(self.switches):
+            if switch.direction >= 0:
+                continue
+            recovery = next((later.wall_time - switch.wall_time
+                             for later in self.switches[index + 1:]
+                             if later.direction > 0), None)
+            times.append(recovery)
+        return times
+
+    def upswitch_latencies(self, wall_times):
+        """
+        Return, for each of `wall_times`, such as when bandwidth went up,
+        seconds until the next upswitch, or None if there was none before
+        the next of `wall_times`.
+        """
+        wall_times = sorted(wall_times)
+        latencies = []
+        for index, t in enumerate(wall_times):
+            until = (wall_times[index + 1] if index + 1 < len(wall_times)
+                     else None)
+            latencies.append(next(
+                (switch.wall_time - t for switch in self.upswitches
+                 if switch.wall_time >= t and
+                 (until is None or switch.wall_time < until)), None))
+        return latencies
+
+    def summary(self):
+        """
+        :return: dict of ABR metrics: switch_count, upswitch_count,
+            downswitch_count, switches_per_minute, time_at_level (seconds
+            per level), recovery_times (per downswitch, seconds until the
+            next upswitch) and switches (as dicts)
+        """
+        return {
+            'switch_count': len(self.switches),
+            'upswitch_count': len(self.upswitches),
+            'downswitch_count': len(self.downswitches),
+            'switches_per_minute': self.switches_per_minute(),
+            'time_at_level': dict(self.time_at_level),
+            'recovery_times': self.recovery_times(),
+            'switches': [switch._asdict() for switch in self.switches],
+        }
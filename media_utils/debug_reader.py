@@ -0,0 +1,186 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import json
+import re
+
+# e.g. "Video State: ni=1 no=1 ie=0 demuxr:0 demuxq:3 decoder:0 pending:0"
+_state = re.compile(r'^(?P<track>audio|video) state:\s*(?P<fields>.*)$',
+                    re.IGNORECASE)
+# e.g. "Dumping Audio Track Buffer(audio/mp4a-latm): - mLastAudioTime: 1.5"
+_track_buffer = re.compile(r'^Dumping (?P<track>audio|video) Track '
+                           r'Buffer\((?P<mime>[^)]*)\)[:\s-]*'
+                           r'(?:mLast\w+Time:\s*(?P<last_time>\S+))?',
+                           re.IGNORECASE)
+# e.g. "Buffered: ranges=[(0.000000, 10.000000), (12.000000, 15.000000)]"
+_buffered = re.compile(r'^Buffered:\s*ranges=\[(?P<ranges>.*)\]')
+_range = re.compile(r'\(\s*([-\d.e+]+)\s*,\s*([-\d.e+]+)\s*\)')
+# key=value or key:value tokens
+_field = re.compile(r'(\w+)[=:]\s*(\S+)')
+# e.g. "audio decoder: ffmpeg audio decoder"
+_key_value = re.compile(r'^(?P<key>[\w ]+?):\s*(?P<value>.+)$')
+
+
+def _number(text):
+    """ Return `text` as an int or float if it is one, or unchanged. """
+    for convert in (int, float):
+        try:
+            return convert(text)
+        except ValueError:
+            pass
+    return text
+
+
+def parse_debug_lines(lines):
+    """
+    Parse the lines of mozDebugReaderData, as returned by debug_script, into
+    a dict with:
+        'reader' - dict of the reader's "key: value" lines, such as decoder
+            names and decoded frame counts
+        'state' - dict of track ('audio' or 'video') to a dict of the
+            fields of its decoding state line, such as demuxq (demuxed
+            samples queued for decoding) and pending (decoded samples not
+            yet output)
+        'track_buffers' - dict of track to a dict with 'mime', 'last_time',
+            the sample counts and indices of its track buffer and
+            'buffered', a list of (start, end) ranges
+
+    Lines that match none of these are ignored.
+    """
+    data = {'reader': {}, 'state': {}, 'track_buffers': {}}
+    track_buffer = None
+    for line in lines or []:
+        line = line.strip()
+        if not line:
+            continue
+        match = _state.match(line)
+        if match:
+            data['state'][match.group('track').lower()] = dict(
+                (key, _number(value)) for key, value
+                in _field.findall(match.group('fields')))
+            continue
+        match = _track_buffer.match(line)
+        if match:
+            track_buffer = {'mime': match.group('mime'), 'buffered': []}
+            if match.group('last_time') is not None:
+                track_buffer['last_time'] = _number(match.group('last_time'))
+            data['track_buffers'][match.group('track').lower()] = track_buffer
+            continue
+        match = _buffered.match(line)
+        if match:
+            if track_buffer is not None:
+                track_buffer['buffered'] = [
+                    (float(start), float(end)) for start, end
+                    in _range.findall(match.group('ranges'))]
+            continue
+        if track_buffer is not None and line.startswith('NumSamples'):
+            track_buffer.update((key, _number(value)) for key, value
+                                in _field.findall(line))
+            continue
+        if line.startswith('Dumping data for demuxer'):
+            continue
+        match = _key_value.match(line)
+        if match:
+            data['reader'][match.group('key')] = _number(
+                match.group('value').strip())
+    return data
+
+
+def flatten(data, prefix=''):
+    """
+    Return nested dict `data` as a flat dict with dotted keys, such as
+    'state.video.demuxq'. Lists are kept as values.
+    """
+    flat = {}
+    for key, value in data.items():
+        name = prefix + key
+        if isinstance(value, dict):
+            flat.update(flatten(value, name + '.'))
+        else:
+            flat[name] = value
+    return flat
+
+
+def diff(old, new):
+    """
+    Return the changes from flat dict `old` to flat dict `new`: the keys
+    whose values differ, with their new value, and removed keys, with None.
+    """
+    changes = dict((key, value) for key, value in new.items()
+                   if old.get(key, None) != value or key not in old)
+    changes.update((key, None) for key in old if key not in new)
+    return changes
+
+
+class DebugReaderLog(object):
+    """
+    Captures of mozDebugReaderData over time, stored as the first capture
+    followed by the changes between consecutive captures.
+
+    Inputs:
+        url - The URL of the page containing the video element.
+    """
+    def __init__(self, url):
+        self.url = url
+        self.first = None
+        # list of (wall time, changes since the previous capture)
+        self.changes = []
+        self._last = None
+
+    def __len__(self):
+        return len(self.changes) + (self.first is not None)
+
+    def add(self, wall_time, lines):
+        """
+        Parse `lines` of mozDebugReaderData and store what changed since the
+        previous capture.
+
+        :return: the parsed data, as returned by parse_debug_lines
+        """
+        data = parse_debug_lines(lines)
+        flat = flatten(data)
+        if self.first is None:
+            self.first = (wall_time, flat)
+        else:
+            self.changes.append((wall_time, diff(self._last, flat)))
+        self._last = flat
+        return data
+
+    def states(self):
+        """
+        Generate (wall time, flat state) for each capture, oldest first.
+        """
+        if self.first is None:
+            return
+        wall_time, state = self.first
+        state = dict(state)
+        yield wall_time, dict(state)
+        for wall_time, changes in self.changes:
+            for key, value in changes.items():
+                if value is None:
+                    state.pop(key, None)
+                else:
+                    state[key] = value
+            yield wall_time, dict(state)
+
+    def series(self, key):
+        """
+        Return a list of (wall time, value) of flat `key`, such as
+        'state.video.demuxq', over all captures; value is None where the key
+        was absent.
+        """
+        return [(wall_time, state.get(key))
+                for wall_time, state in self.states()]
+
+    def to_dict(self):
+        return {
+            'url': self.url,
+            'first': self.first,
+            'changes': self.changes,
+        }
+
+    def to_json(self, path):
+        """ Write all captures to `path` as JSON. """
+        with open(path, 'w') as f:
+            json.dump(self.to_dict(), f)
@@ -0,0 +1,847 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+from collections import Counter
+from contextlib import contextmanager
+from json import dumps
+import re
+
+from marionette_driver import By
+from marionette_driver.errors import NoSuchElementException
+
+from playback_sampler import drain_script, install_script, uninstall_script
+from video_puppeteer import (completion_script, debug_script,
+                             element_debug_script, generation_script,
+                             playback_rate_script, resource_buffer_script,
+                             resource_timing_script, snapshot_script,
+                             start_script)
+from youtube_puppeteer import ad_script, yt_snapshot_script
+
+
+class UnsupportedScript(Exception):
+    """ A script that FakeMarionette does not know how to simulate. """
+    pass
+
+
+class VirtualClock(object):
+    """
+    A clock that only moves when slept on, so that simulated playback of any
+    length takes no real time.
+
+    It has the interface of marionette_driver.wait.SystemClock, so it can be
+    passed to Wait and to the puppeteers as their `clock`.
+    """
+    def __init__(self, start=0):
+        self._now = start
+
+    @property
+    def now(self):
+        return self._now
+
+    def sleep(self, duration):
+        self._now += max(duration, 0)
+
+
+class SimulatedVideo(object):
+    """
+    A <video> element that plays in simulated time.
+
+    Playback advances lazily, whenever the element is inspected, according
+    to `clock`. Stalls are scripted as (media time, seconds) pairs: when
+    currentTime reaches the media time, it stands still for that many
+    seconds of wall time, as if the element were waiting for data.
+
+    Inputs:
+        clock - Object with a `now` property in seconds, like
+            marionette_driver.wait.SystemClock.
+        duration - Duration of the stream in seconds.
+        src - Value of the src attribute.
+        startup_delay - Seconds of waiting before the first frame.
+        stalls - List of (media time, seconds) pairs.
+        fps - Frame rate used to derive frame counts.
+        dropped_ratio - Fraction of frames reported as dropped.
+        size - (videoWidth, videoHeight)
+        buffer_ahead - Seconds buffered ahead of currentTime, except during
+            a stall.
+        autoplay - Whether playback starts without calling play().
+    """
+    def __init__(self, clock, duration, src='mediasource:http://simulated/',
+                 startup_delay=0.5, stalls=(), fps=30, dropped_ratio=0,
+                 size=(1280, 720), buffer_ahead=30, autoplay=True):
+        self.clock = clock
+        self.duration = duration
+        self.src = src
+        self.fps = fps
+        self.dropped_ratio = dropped_ratio
+        self.size = size
+        self.buffer_ahead = buffer_ahead
+        self.playback_rate = 1
+        self.position = 0
+        self.paused = not autoplay
+        self.ended = False
+        self.stall_left = 0
+        self.stalls = sorted(stalls)
+        if startup_delay:
+            self.stalls.insert(0, (0, startup_delay))
+        # (media time, callback(wall time)) pairs, see add_cue
+        self.cues = []
+        self.listeners = []
+        self.last_update = clock.now
+
+    def add_listener(self, listener):
+        """
+        Call `listener(event type, wall time, currentTime)` for every
+        simulated element event.
+        """
+        self.listeners.append(listener)
+
+    def remove_listener(self, listener):
+        self.listeners.remove(listener)
+
+    def emit(self, event_type, wall_time):
+        for listener in list(self.listeners):
+            listener(event_type, wall_time, self.position)
+
+    def add_cue(self, media_time, callback):
+        """
+        Call `callback(wall time)` when playback reaches `media_time`.
+        """
+        self.cues.append((media_time, callback))
+        self.cues.sort(key=lambda cue: cue[0])
+
+    def stall(self, seconds, media_time=None):
+        """
+        Stall for `seconds` when playback reaches `media_time`, or right now.
+        """
+        self.update()
+        if media_time is None or media_time <= self.position:
+            self.stall_left += seconds
+        else:
+            self.stalls.append((media_time, seconds))
+            self.stalls.sort()
+
+    def play(self, at=None):
+        self.update(at)
+        if self.paused:
+            if at is not None:
+                # nothing happens while paused, so resuming in the past is
+                # safe
+                self.last_update = at
+            self.paused = False
+            self.emit('playing', self.last_update)
+
+    def pause(self, at=None):
+        self.update(at)
+        self.paused = True
+
+    def end(self, at=None):
+        self.update(at)
+        self.position = self.duration
+        self.ended = True
+        self.emit('ended', self.last_update)
+
+    @property
+    def stalled(self):
+        self.update()
+        return self.stall_left > 0 and not self.paused
+
+    def update(self, now=None):
+        """ Advance playback to `now`, by default the clock's current time.
+        """
+        now = self.clock.now if now is None else now
+        elapsed = now - self.last_update
+        t = self.last_update
+        while not (self.paused or self.ended):
+            if self.stall_left > 0:
+                if elapsed <= 0:
+                    break
+                step = min(elapsed, self.stall_left)
+                self.stall_left -= step
+                elapsed -= step
+                t += step
+                if self.stall_left <= 0:
+                    self.emit('playing', t)
+                continue
+            if self.stalls and self.stalls[0][0] <= self.position:
+                self.stall_left = self.stalls.pop(0)[1]
+                self.emit('waiting', t)
+                continue
+            if self.cues and self.cues[0][0] <= self.position:
+                # the callback may pause or stall this element at t
+                self.last_update = t
+                self.cues.pop(0)[1](t)
+                elapsed = now - self.last_update
+                t = self.last_update
+                continue
+            if elapsed <= 0:
+                break
+            boundary = min([self.duration] +
+                           [s[0] for s in self.stalls[:1]] +
+                           [c[0] for c in self.cues[:1]])
+            step = min(elapsed,
+                       (boundary - self.position) / float(self.playback_rate))
+            self.position += step * self.playback_rate
+            elapsed -= step
+            t += step
+            self.emit('timeupdate', t)
+            if self.position >= self.duration:
+                self.position = self.duration
+                self.ended = True
+                self.emit('ended', t)
+        self.last_update = max(now, self.last_update)
+
+    @property
+    def frames(self):
+        total = int(self.position * self.fps)
+        return total, int(total * self.dropped_ratio), 0
+
+    def state(self):
+        """
+        Return element state like video_state_script does, minus video_url.
+        """
+        self.update()
+        total, dropped, corrupted = self.frames
+        buffered_end = self.position
+        if not self.stall_left:
+            buffered_end = min(self.duration,
+                               self.position + self.buffer_ahead)
+        return {
+            'current_time': self.position,
+            'duration': self.duration,
+            'paused': self.paused,
+            'ended': self.ended,
+            'seeking': False,
+            'ready_state': 2 if self.stall_left else 4,
+            'network_state': 2,
+            'playback_rate': self.playback_rate,
+            'video_width': self.size[0],
+            'video_height': self.size[1],
+            'buffered': [[0, buffered_end]],
+            'video_src': self.src,
+            'total_frames': total,
+            'dropped_frames': dropped,
+            'corrupted_frames': corrupted,
+        }
+
+
+class SimulatedAd(object):
+    """
+    An ad spliced into a SimulatedPlayer's video at `at` seconds of the main
+    video. If `skippable_after` is not None, the skip button appears that
+    many seconds into the ad.
+    """
+    def __init__(self, at, duration, skippable_after=None, ad_format=1):
+        self.at = at
+        self.duration = duration
+        self.skippable_after = skippable_after
+        self.ad_format = ad_format
+        self.stream = None
+
+
+class SimulatedPlayer(object):
+    """
+    A YouTube #movie_player around a SimulatedVideo, with scripted ads.
+
+    While an ad plays, the main video is held and the video element shows
+    the ad's stream instead.
+    """
+    _state = {'UNSTARTED': -1, 'ENDED': 0, 'PLAYING': 1, 'PAUSED': 2,
+              'BUFFERING': 3, 'CUED': 5}
+
+    def __init__(self, video, ads=(), video_id='simulated',
+                 title='Simulated video', quality='hd720'):
+        self.main = video
+        self.clock = video.clock
+        self.video_id = video_id
+        self.title = title
+        self.quality = quality
+        self.pending_ads = sorted(ads, key=lambda ad: ad.at)
+        self.ad = None
+        self.ads_played = 0
+        # the video element changes resource at the start and end of ads
+        self.generation = 0
+        for ad in self.pending_ads:
+            video.add_cue(ad.at, lambda t, ad=ad: self.start_ad(ad, t))
+
+    def start_ad(self, ad, at):
+        self.main.pause(at)
+        ad.stream = SimulatedVideo(self.clock, ad.duration, src='', fps=25,
+                                   startup_delay=0, autoplay=False)
+        ad.stream.last_update = at
+        ad.stream.play(at)
+        self.ad = ad
+        self.generation += 1
+
+    def end_ad(self, at=None):
+        ad = self.ad
+        at = ad.stream.last_update if at is None else at
+        self.ad = None
+        self.generation += 1
+        self.pending_ads.remove(ad)
+        self.ads_played += 1
+        self.main.play(at)
+
+    def update(self):
+        now = self.clock.now
+        self.main.update(now)
+        while self.ad:
+            self.ad.stream.update(now)
+            if not self.ad.stream.ended:
+                break
+            self.end_ad()
+            self.main.update(now)
+
+    @property
+    def stream(self):
+        """ The SimulatedVideo currently shown by the video element. """
+        self.update()
+        return self.ad.stream if self.ad else self.main
+
+    @property
+    def skip_displayed(self):
+        stream = self.stream
+        return bool(self.ad and self.ad.skippable_after is not None and
+                    stream.position >= self.ad.skippable_after)
+
+    def skip_ad(self):
+        if self.skip_displayed:
+            self.end_ad(self.clock.now)
+
+    @property
+    def ad_countdown(self):
+        stream = self.stream
+        if not self.ad:
+            return ''
+        left = int(stream.duration - stream.position)
+        return 'Ad %d:%02d' % (left // 60, left % 60)
+
+    def getPlayerState(self):
+        stream = self.stream
+        if self.ad:
+            return self._state['PLAYING']
+        if stream.ended:
+            return self._state['ENDED']
+        if stream.paused:
+            return self._state['PAUSED']
+        if stream.stalled:
+            return self._state['BUFFERING']
+        return self._state['PLAYING']
+
+    def getAdState(self):
+        self.update()
+        if self.ad:
+            return self._state['PLAYING']
+        if self.ads_played:
+            return self._state['ENDED']
+        return self._state['UNSTARTED']
+
+    def getCurrentTime(self):
+        self.update()
+        return self.main.position
+
+    def getDuration(self):
+        return self.stream.duration
+
+    def getPlaybackQuality(self):
+        return self.quality
+
+    def getVideoData(self):
+        return {'video_id': self.video_id, 'title': self.title}
+
+    def getVideoUrl(self):
+        return 'https://www.youtube.com/watch?v=%s' % self.video_id
+
+    def getDebugText(self):
+        return dumps({'debug_videoId': self.video_id})
+
+    def getOption(self, module, option):
+        self.update()
+        if option == 'displaystate':
+            if not self.ad:
+                return None
+            return {'adFormat': self.ad.ad_format,
+                    'skippable': self.ad.skippable_after is not None}
+        if option == 'breakscount':
+            return len(self.pending_ads) or None
+
+    def playVideo(self):
+        self.stream.play()
+
+    def pauseVideo(self):
+        self.stream.pause()
+
+
+class FakePage(object):
+    """
+    What FakeMarionette shows after navigating to `url`: a video element
+    and, for YouTube pages, a SimulatedPlayer around it.
+
+    Media is fetched in segments of `segment_duration` seconds at `bitrate`
+    kbps, as the buffer grows; see FakeMarionette._resource_entries. Like
+    Firefox, the page keeps `resource_buffer_size` resource timing entries
+    unless resource_buffer_script grows its buffer, and drops the rest.
+    """
+    segment_duration = 5
+    bitrate = 2000
+    resource_buffer_size = 250
+
+    def __init__(self, url, video, player=None):
+        self.url = url
+        self.video = video
+        self.player = player
+        self.autoplay_checked = True
+        self.sampler = None
+        # wall time of navigation, from which page times count
+        self.time_origin = 0
+        # resource timing entries, see resource_timing_script
+        self.resources = []
+        # resourcetimingbufferfull events, if resource_buffer_script ran
+        self.buffer_full = None
+        self.fetched_until = 0
+        self._last_fetch = 0
+
+    @property
+    def stream(self):
+        return self.player.stream if self.player else self.video
+
+    @property
+    def generation(self):
+        if self.player:
+            self.player.update()
+            return self.player.generation
+        return 0
+
+
+class FakeElement(object):
+    def __init__(self, page, kind):
+        self.page = page
+        self.kind = kind
+
+    def get_attribute(self, name):
+        if self.kind == 'video' and name == 'src':
+            return self.page.stream.src or None
+        return None
+
+    def is_displayed(self):
+        if self.kind == 'skip':
+            return self.page.player.skip_displayed
+        return True
+
+    def click(self):
+        if self.kind == 'skip':
+            self.page.player.skip_ad()
+        elif self.kind == 'autoplay':
+            self.page.autoplay_checked = not self.page.autoplay_checked
+
+    @property
+    def text(self):
+        if self.kind == 'countdown':
+            return self.page.player.ad_countdown
+        return ''
+
+
+class FakeSampler(object):
+    """ Stands in for the in-page sampler of playback_sampler. """
+    def __init__(self, page, capacity):
+        self.page = page
+        self.capacity = capacity
+        self.records = []
+        self.lost = 0
+        self.origin = page.video.clock.now
+        page.video.add_listener(self.record)
+
+    def record(self, event_type, wall_time, current_time):
+        if event_type not in ('timeupdate', 'waiting', 'playing'):
+            return
+        self.records.append([wall_time - self.origin, event_type,
+                             current_time, None])
+        if len(self.records) > self.capacity:
+            self.records.pop(0)
+            self.lost += 1
+
+    def drain(self):
+        self.page.stream.update()
+        drained = {'records': self.records, 'lost': self.lost}
+        self.records = []
+        self.lost = 0
+        return drained
+
+    def stop(self):
+        self.page.video.remove_listener(self.record)
+
+
+class FakeMarionette(object):
+    """
+    Stands in for a Marionette client driving Firefox, for running
+    VideoPuppeteer and YouTubePuppeteer against simulated pages.
+
+    Pages are registered with `add_page`. Only the scripts that the
+    puppeteers send are understood; any other script raises
+    UnsupportedScript.
+
+    Every command counts as one round trip, recorded in `commands` by
+    command and in `scripts` by script, and advances `clock` by `latency`
+    seconds through `clock.sleep`. Scripts run `split` of the way through
+    the round trip.
+
+    Pass the same clock to the puppeteers, so that their waits advance the
+    simulation.
+
+    Inputs:
+        clock - Object with a `now` property and a `sleep` method, like
+            marionette_driver.wait.SystemClock. Defaults to a VirtualClock.
+        latency - Simulated seconds per round trip.
+        split - Fraction of `latency` that passes before a script runs.
+            Default 0.5.
+    """
+    CONTEXT_CHROME = 'chrome'
+    CONTEXT_CONTENT = 'content'
+
+    def __init__(self, clock=None, latency=0, split=0.5):
+        self.clock = clock or VirtualClock()
+        self.latency = latency
+        self.split = split
+        self.session = {}
+        self.context = self.CONTEXT_CONTENT
+        self.pages = {}
+        self.page = None
+        self.logs = []
+        self.commands = Counter()
+        self.scripts = Counter()
+        self.simulated_latency = 0
+        self._scripts = {
+            snapshot_script: ('snapshot', self._snapshot),
+            yt_snapshot_script: ('yt_snapshot', self._yt_snapshot),
+            install_script: ('sampler_install', self._install_sampler),
+            drain_script: ('sampler_drain', self._drain_sampler),
+            uninstall_script: ('sampler_uninstall', self._uninstall_sampler),
+            debug_script: ('debug', self._debug_lines),
+            element_debug_script: ('element_debug', self._debug_lines),
+            playback_rate_script: ('playback_rate', self._set_playback_rate),
+            generation_script: ('generation',
+                                lambda video: self.page.generation),
+            resource_buffer_script: ('resource_buffer',
+                                     self._grow_resource_buffer),
+            resource_timing_script: ('resource_timing',
+                                     self._resource_entries),
+            completion_script: ('completion', self._wait_for_completion),
+            start_script: ('start', self._wait_for_start),
+            ad_script: ('ad', self._wait_for_ad),
+        }
+        self._patterns = [
+            (re.compile(r'^log\((.*)\);?$'), self._log_script),
+            (re.compile(r'^(return)?arguments\[0\]\.wrappedJSObject\.'
+                        r'(\w+)\(\);?$'), self._element_call),
+            (re.compile(r'^returnarguments\[0\]\.wrappedJSObject\.(\w+);?$'),
+             self._element_property),
+            (re.compile(r'^returnarguments\[0\]\.getVideoPlaybackQuality\(\)'
+                        r'\["(\w+)"\];?$'), self._quality),
+            (re.compile(r'^returnarguments\[0\]\.baseURI;?$'),
+             lambda match, args: self.page.url),
+            (re.compile(r'^(return)?arguments\[1\]\.wrappedJSObject\.(\w+)'
+                        r'\((.*?)\)(\["(\w+)"\])?;?$'), self._player_call),
+        ]
+
+    def add_page(self, url, video, player=None):
+        """
+        Show `video` (and `player`, for YouTube pages) when navigating to
+        `url`. Return the FakePage.
+        """
+        self.pages[url] = FakePage(url, video, player)
+        return self.pages[url]
+
+    @property
+    def round_trips(self):
+        return sum(self.commands.values())
+
+    def _command(self, name, run=None):
+        self.commands[name] += 1
+        self.simulated_latency += self.latency
+        self.clock.sleep(self.latency * self.split)
+        result = run() if run else None
+        self.clock.sleep(self.latency * (1 - self.split))
+        return result
+
+    @contextmanager
+    def using_context(self, context):
+        previous = self.context
+        self.context = context
+        try:
+            yield
+        finally:
+            self.context = previous
+
+    def log(self, msg, level=None):
+        self._command('log')
+        self.logs.append((level or 'INFO', msg))
+
+    def navigate(self, url):
+        self._command('navigate')
+        if url not in self.pages:
+            raise ValueError('No simulated page for %s' % url)
+        self.page = self.pages[url]
+        self.page.video.last_update = self.clock.now
+        self.page.time_origin = self.page._last_fetch = self.clock.now
+
+    def _find(self, by, value):
+        page = self.page
+        if page is None:
+            return []
+        if (by == By.TAG_NAME and value == 'video' or
+                by == By.CSS_SELECTOR and value in ('video',
+                                                    '#movie_player video')):
+            return [FakeElement(page, 'video')]
+        if not page.player:
+            return []
+        if by == By.ID and value == 'movie_player':
+            return [FakeElement(page, 'player')]
+        if by == By.ID and value == 'autoplay-checkbox':
+            return [FakeElement(page, 'autoplay')]
+        if by == By.CSS_SELECTOR and value.endswith('.videoAdUiSkipContainer'):
+            if page.player.skip_displayed:
+                return [FakeElement(page, 'skip')]
+        if by == By.CSS_SELECTOR and value.endswith('.videoAdUiAttribution'):
+            if page.player.ad:
+                return [FakeElement(page, 'countdown')]
+        return []
+
+    def find_elements(self, by, value):
+        self._command('find_elements')
+        return self._find(by, value)
+
+    def find_element(self, by, value):
+        self._command('find_element')
+        found = self._find(by, value)
+        if not found:
+            raise NoSuchElementException('Unable to locate element: %s' %
+                                         value)
+        return found[0]
+
+    def execute_script(self, script, script_args=None, **kwargs):
+        return self._command('execute_script',
+                             lambda: self._run(script, script_args or []))
+
+    def execute_async_script(self, script, script_args=None, **kwargs):
+        return self._command('execute_async_script',
+                             lambda: self._run(script, script_args or []))
+
+    def _run(self, script, args):
+        if script in self._scripts:
+            name, handler = self._scripts[script]
+            self.scripts[name] += 1
+            return handler(*args)
+        normalized = re.sub(r'\s+', '', script)
+        for pattern, handler in self._patterns:
+            match = pattern.match(normalized)
+            if match:
+                self.scripts[normalized] += 1
+                return handler(match, args)
+        raise UnsupportedScript(script)
+
+    # Handlers for the puppeteers' scripts
+
+    def _log_script(self, match, args):
+        self.logs.append(('INFO', match.group(1)))
+
+    def _element_call(self, match, args):
+        element, method = args[0], match.group(2)
+        if method == 'click':
+            element.click()
+        elif method == 'play':
+            self.page.stream.play()
+        elif method == 'pause':
+            self.page.stream.pause()
+        else:
+            raise UnsupportedScript(match.group(0))
+
+    def _element_property(self, match, args):
+        element, name = args[0], match.group(1)
+        if name == 'checked':
+            return element.page.autoplay_checked
+        state = self.page.stream.state()
+        names = {'currentTime': 'current_time', 'duration': 'duration',
+                 'paused': 'paused', 'ended': 'ended',
+                 'playbackRate': 'playback_rate'}
+        if name not in names:
+            raise UnsupportedScript(match.group(0))
+        return state[names[name]]
+
+    def _set_playback_rate(self, video, rate):
+        stream = self.page.stream
+        stream.update()
+        stream.playback_rate = rate
+
+    def _quality(self, match, args):
+        total, dropped, corrupted = self.page.stream.frames
+        return {'totalVideoFrames': total,
+                'droppedVideoFrames': dropped,
+                'corruptedVideoFrames': corrupted}.get(match.group(1))
+
+    def _player_call(self, match, args):
+        player = self.page.player
+        method = getattr(player, match.group(2), None)
+        if method is None:
+            raise UnsupportedScript(match.group(0))
+        call_args = [arg.strip('"\'') for arg in match.group(3).split(',')
+                     if arg]
+        result = method(*call_args)
+        if match.group(5):
+            result = result[match.group(5)]
+        return result
+
+    def _snapshot(self, video, *args):
+        state = self.page.stream.state()
+        state['video_url'] = self.page.url
+        state['generation'] = self.page.generation
+        state['page_time'] = (self.clock.now - self.page.time_origin) * 1000
+        return state
+
+    def _yt_snapshot(self, video, player, *args):
+        state = self._snapshot(video)
+        player = self.page.player
+        video_data = player.getVideoData()
+        display_state = player.getOption('ad', 'displaystate')
+        state.update({
+            'player_state': player.getPlayerState(),
+            'ad_state': player.getAdState(),
+            'player_current_time': player.getCurrentTime(),
+            'player_duration': player.getDuration(),
+            'playback_quality': player.getPlaybackQuality(),
+            'movie_id': video_data['video_id'],
+            'movie_title': video_data['title'],
+            'player_url': player.getVideoUrl(),
+            'breaks_count': player.getOption('ad', 'breakscount'),
+            'ad_format': (display_state or {}).get('adFormat', False),
+            'ad_skippable': (display_state or {}).get('skippable', False),
+        })
+        return state
+
+    def _install_sampler(self, video, capacity, quality_interval):
+        if self.page.sampler:
+            return False
+        self.page.sampler = FakeSampler(self.page, capacity)
+        return True
+
+    def _drain_sampler(self, video):
+        if not self.page.sampler:
+            return None
+        return self.page.sampler.drain()
+
+    def _uninstall_sampler(self, video):
+        if self.page.sampler:
+            self.page.sampler.stop()
+            self.page.sampler = None
+
+    def _debug_lines(self, *args):
+        if self.page is None:
+            return None
+        state = self.page.stream.state()
+        return ['MediaFormatReader',
+                'Video state: ni=1 no=1 ie=0 demuxr:0 demuxq:0 '
+                'decoder:0 pending:0 waiting:%d' % bool(state['ready_state']
+                                                        < 3),
+                'Dumping data for demuxer:',
+                '\tDumping Video Track Buffer(video/mp4): - mLastVideoTime: '
+                '%f' % state['buffered'][0][1],
+                '\t\tNumSamples:%d Size:%d NextGetSampleIndex:%d '
+                'NextInsertionIndex:-1' % (state['total_frames'],
+                                           state['total_frames'] * 4096,
+                                           state['total_frames']),
+                '\t\tBuffered: ranges=[(%f, %f)]' % tuple(
+                    state['buffered'][0])]
+
+    def _grow_resource_buffer(self):
+        page = self.page
+        if page.buffer_full is None:
+            page.buffer_full = 0
+            page.resource_buffer_size = 100000
+
+    def _resource_entries(self, video, start):
+        self._grow_resource_buffer()
+        page = self.page
+        now = self.clock.now
+        buffered_end = page.stream.state()['buffered'][0][1]
+        count = 0
+        while (page.fetched_until + count * page.segment_duration <
+               buffered_end):
+            count += 1
+        # the segments fetched since the last call arrived evenly over it
+        step = (now - page._last_fetch) / float(count or 1)
+        size = page.segment_duration * page.bitrate * 1000 / 8
+        for i in range(count):
+            if len(page.resources) >= page.resource_buffer_size:
+                page.buffer_full += 1
+                page.resource_buffer_size *= 2
+            begin = (page._last_fetch + i * step - page.time_origin) * 1000
+            page.resources.append(
+                ['%s/segment%s.m4s' % (page.url, len(page.resources)),
+                 'xmlhttprequest', begin, begin + step * 100,
+                 begin + step * 1000, size, None])
+        page.fetched_until += count * page.segment_duration
+        page._last_fetch = now
+        if len(page.resources) < start:
+            start = 0
+        return {'next': len(page.resources),
+                'now': (now - page.time_origin) * 1000,
+                'entries': page.resources[start:],
+                'buffer_full': page.buffer_full}
+
+    def _wait_for_completion(self, video, expected_duration, stall_wait_time,
+                             initial_lag, chunk, step=0.25):
+        start = self.clock.now
+        stream = self.page.stream
+        # [lag, wall time and position of the last check]
+        last = [initial_lag, start, stream.state()['current_time']]
+
+        def lag():
+            state = stream.state()
+            last[0] += (self.clock.now - last[1] -
+                        (state['current_time'] - last[2]) /
+                        float(state['playback_rate'] or 1))
+            last[1:] = [self.clock.now, state['current_time']]
+            return last[0]
+
+        def result(reason):
+            return {'reason': reason,
+                    'current_time': stream.state()['current_time'],
+                    'elapsed': self.clock.now - start, 'lag': lag()}
+
+        while True:
+            state = stream.state()
+            current_lag = lag()
+            if state['ended']:
+                return result('ended')
+            if state['current_time'] >= expected_duration:
+                return result('duration')
+            if stall_wait_time and current_lag > stall_wait_time:
+                return result('stalled')
+            if self.clock.now - start >= chunk:
+                return result('running')
+            self.clock.sleep(step)
+
+    def _wait_for_ad(self, video, player, skip, timeout, until_ready,
+                     step=0.25):
+        start = self.clock.now
+        player = self.page.player
+        while self.clock.now - start < timeout:
+            player.update()
+            if not player.ad:
+                stream = player.stream
+                if not until_ready or (stream.duration and
+                                       not stream.stalled):
+                    return 'ended'
+            elif skip and player.skip_displayed:
+                player.skip_ad()
+                return 'skipped'
+            self.clock.sleep(step)
+        return 'timeout'
+
+    def _wait_for_start(self, video, start_time, timeout, step=0.25):
+        start = self.clock.now
+        while self.clock.now - start < timeout:
+            current_time = self.page.stream.state()['current_time']
+            if current_time > start_time:
+                return current_time
+            self.clock.sleep(step)
+        return None
@@ -0,0 +1,138 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+from array import array
+import csv
+import json
+
+
+class PlaybackMetrics(object):
+    """
+    Time series of playback state, recorded from VideoPuppeteer snapshots.
+
+    Each column is a typed array rather than a list of objects, so a sample
+    costs a few dozen bytes and hour-long runs stay small in memory.
+
+    Inputs:
+        url - The URL of the page containing the video element.
+        marks - Optional TimingMarks of the puppeteer, included in to_dict.
+        qoe - Optional StallDetector of the puppeteer, whose summary is
+            included in to_dict.
+        network - Optional TraceShaper that shaped the network during
+            playback. Its trace is included in to_dict and the limits in
+            effect at each sample are added to the CSV.
+        resources - Optional ResourceTimingLog of the puppeteer. Its fetches
+            are included in to_dict, and the throughput delivered and the
+            fraction of time spent fetching since the previous sample are
+            added as series.
+        abr - Optional AbrTracker of the puppeteer, whose summary is
+            included in to_dict, along with how long quality took to go up
+            after each increase of bandwidth by `network`.
+    """
+    # column name -> array typecode
+    columns = [
+        ('wall_time', 'd'),
+        ('current_time', 'd'),
+        ('lag', 'd'),
+        ('total_frames', 'l'),
+        ('dropped_frames', 'l'),
+        ('corrupted_frames', 'l'),
+        ('video_width', 'l'),
+        ('video_height', 'l'),
+    ]
+
+    def __init__(self, url, marks=None, qoe=None, network=None,
+                 resources=None, abr=None):
+        self.url = url
+        self.marks = marks
+        self.qoe = qoe
+        self.network = network
+        self.resources = resources
+        self.abr = abr
+        self.series = dict((name, array(typecode))
+                           for name, typecode in self.columns)
+
+    def __len__(self):
+        return len(self.series['wall_time'])
+
+    def record(self, state):
+        """
+        Append a sample taken from `state`, a VideoSnapshot.
+        """
+        self.series['wall_time'].append(state.wall_time)
+        self.series['current_time'].append(state.current_time)
+        self.series['lag'].append(state.lag)
+        self.series['total_frames'].append(state.total_frames or 0)
+        self.series['dropped_frames'].append(state.dropped_frames)
+        self.series['corrupted_frames'].append(state.corrupted_frames)
+        self.series['video_width'].append(state.video_width or 0)
+        self.series['video_height'].append(state.video_height or 0)
+
+    def to_dict(self):
+        result = {
+            'url': self.url,
+            'series': dict((name, self.series[name].tolist())
+                           for name, _ in self.columns),
+        }
+        if self.marks is not None:
+            result['timing'] = self.marks.to_dict()
+        if self.qoe is not None:
+            result['qoe'] = self.qoe.summary()
+        if self.network is not None:
+            result['network'] = self.network.to_dict()
+        if self.abr is not None:
+            result['abr'] = self.abr.summary()
+            if self.network is not None:
+                result['abr']['upswitch_latency'] = (
+                    self.abr.upswitch_latencies(self._bandwidth_increases()))
+        if self.resources:
+            result['resources'] = self.resources.to_dict()
+            throughput, busy = self._resource_series()
+            result['series']['throughput_kbps'] = throughput
+            result['series']['fetch_busy'] = busy
+        return result
+
+    def _bandwidth_increases(self):
+        """ Return the wall times at which self.network raised bandwidth.
+        """
+        increases = []
+        last = None
+        for wall_time, point in self.network.applied:
+            kbps = point.downstream_kbps or float('inf')
+            if last is not None and kbps > last:
+                increases.append(wall_time)
+            last = kbps
+        return increases
+
+    def _resource_series(self):
+        """
+        Return lists of throughput (kbps) and fraction of time fetching, per
+        sample, over the interval since the previous sample.
+        """
+        series = self.resources.series(self.series['wall_time'].tolist())
+        return [kbps for kbps, _ in series], [busy for _, busy in series]
+
+    def to_json(self, path):
+        """ Write all samples to `path` as a JSON object of columns. """
+        with open(path, 'w') as f:
+            json.dump(self.to_dict(), f)
+
+    def to_csv(self, path):
+        """ Write all samples to `path` as CSV, one row per sample. """
+        names = [name for name, _ in self.columns]
+        columns = [self.series[name] for name in names]
+        if self.network is not None:
+            points = [self.network.limits_at(t)
+                      for t in self.series['wall_time']]
+            names += ['downstream_kbps', 'latency']
+            columns += [[point and point.downstream_kbps for point in points],
+                        [point and point.latency for point in points]]
+        if self.resources:
+            names += ['throughput_kbps', 'fetch_busy']
+            columns += self._resource_series()
+        with open(path, 'wb') as f:
+            writer = csv.writer(f)
+            writer.writerow(names)
+            for row in zip(*columns):
+                writer.writerow(row)
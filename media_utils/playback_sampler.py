@@ -0,0 +1,167 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+from collections import namedtuple
+
+
+# Installs a sampler on the video element passed in as arguments[0].
+# The sampler records element events and periodic playback quality readings
+# into a ring buffer of arguments[1] entries that lives on the element.
+# arguments[2] is the interval in seconds between quality readings; 0 turns
+# them off. Returns false if a sampler is already installed.
+install_script = """
+var video = arguments[0];
+var page = video.wrappedJSObject;
+if (page.__mediaTestSampler) {
+  return false;
+}
+var sampler = {
+  capacity: arguments[1],
+  records: [],
+  written: 0,
+  drained: 0,
+  origin: performance.now(),
+  timer: null,
+  listeners: {}
+};
+function record(type, detail) {
+  sampler.records[sampler.written % sampler.capacity] = [
+    (performance.now() - sampler.origin) / 1000, type, page.currentTime,
+    detail];
+  sampler.written++;
+}
+["timeupdate", "waiting", "stalled", "playing", "seeking", "resize",
+ "ratechange"].forEach(function (type) {
+  var listener = function () {
+    var detail = null;
+    if (type == "resize") {
+      detail = [page.videoWidth, page.videoHeight];
+    } else if (type == "ratechange") {
+      detail = [page.playbackRate];
+    }
+    record(type, detail);
+  };
+  sampler.listeners[type] = listener;
+  video.addEventListener(type, listener);
+});
+if (arguments[2] > 0) {
+  sampler.timer = window.setInterval(function () {
+    var quality = video.getVideoPlaybackQuality();
+    record("quality", [quality["totalVideoFrames"],
+                       quality["droppedVideoFrames"],
+                       quality["corruptedVideoFrames"]]);
+  }, arguments[2] * 1000);
+}
+sampler.stop = function () {
+  for (var type in sampler.listeners) {
+    video.removeEventListener(type, sampler.listeners[type]);
+  }
+  if (sampler.timer !== null) {
+    window.clearInterval(sampler.timer);
+  }
+};
+page.__mediaTestSampler = sampler;
+return true;
+"""
+
+# Returns all records that were written since the last drain, oldest first,
+# along with the number of records that were overwritten before they could
+# be drained.
+drain_script = """
+var sampler = arguments[0].wrappedJSObject.__mediaTestSampler;
+if (!sampler) {
+  return null;
+}
+var first = Math.max(sampler.drained, sampler.written - sampler.capacity);
+var records = [];
+for (var i = first; i < sampler.written; ++i) {
+  records.push(sampler.records[i % sampler.capacity]);
+}
+var lost = first - sampler.drained;
+sampler.drained = sampler.written;
+return {records: records, lost: lost};
+"""
+
+uninstall_script = """
+var page = arguments[0].wrappedJSObject;
+if (page.__mediaTestSampler) {
+  page.__mediaTestSampler.stop();
+  delete page.__mediaTestSampler;
+}
+"""
+
+
+class PlaybackEvent(namedtuple('PlaybackEvent', ['time', 'type',
+                                                 'current_time', 'detail'])):
+    """
+    One record drained from an in-page sampler.
+
+    time - wall time, by the puppeteer's clock, at which it was recorded.
+    type - name of the element event, or 'quality' for a periodic
+        getVideoPlaybackQuality() reading.
+    current_time - currentTime of the video element when recorded.
+    detail - (videoWidth, videoHeight) for 'resize', (playbackRate,) for
+        'ratechange', (total, dropped, corrupted) frame counts for
+        'quality', None otherwise.
+    """
+    __slots__ = ()
+
+
+class PlaybackSampler(object):
+    """
+    Records playback events in the page that contains a video element, to be
+    drained from Python in bulk.
+
+    Events are kept in a ring buffer of `capacity` entries, so the oldest
+    ones are overwritten if the buffer is not drained often enough; `lost`
+    counts how many were overwritten so far.
+
+    The page's clock is lined up with the puppeteer's when the sampler is
+    installed, so that events can be fed to its StallDetector along with
+    snapshots.
+
+    Inputs:
+        video - The VideoPuppeteer whose video element is sampled.
+        capacity - Maximum number of records kept in the page.
+        quality_interval - Seconds between getVideoPlaybackQuality()
+            readings. If 0, only element events are recorded.
+    """
+    def __init__(self, video, capacity=2048, quality_interval=0.25):
+        self.video = video
+        self.capacity = capacity
+        self.quality_interval = quality_interval
+        self.lost = 0
+        # wall time at which the page's sampler clock started
+        self.origin = None
+
+    def start(self):
+        """
+        Install the sampler in the page. Return False if the video element
+        already had one.
+        """
+        before = self.video.clock.now
+        installed = self.video.execute_video_script(
+            install_script,
+            script_args=[self.capacity, self.quality_interval])
+        # assuming the script ran halfway through the round trip
+        self.origin = (before + self.video.clock.now) / 2.0
+        return installed
+
+    def drain(self):
+        """
+        Return a list of PlaybackEvents recorded since the last call.
+        """
+        drained = self.video.execute_video_script(drain_script)
+        if not drained:
+            return []
+        self.lost += drained['lost']
+        return [PlaybackEvent(self.origin + time, event_type, current_time,
+                              tuple(detail) if detail else None)
+                for time, event_type, current_time, detail
+                in drained['records']]
+
+    def stop(self):
+        """ Remove the sampler from the page, discarding undrained records.
+        """
+        self.video.execute_video_script(uninstall_script)
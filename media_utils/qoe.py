@@ -0,0 +1,191 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+from collections import namedtuple
+
+
+class Stall(namedtuple('Stall', ['start', 'end', 'media_time',
+                                 'time_to_recover'])):
+    """
+    One interruption of playback, as recorded by StallDetector.
+
+    start, end - wall time at which media time stopped and resumed
+        advancing; end is None while the stall lasts.
+    media_time - media time at which playback stood still.
+    time_to_recover - seconds from start until playback was steady again,
+        or None if it has not been yet.
+    """
+    __slots__ = ()
+
+    @property
+    def duration(self):
+        if self.end is None:
+            return None
+        return self.end - self.start
+
+
+class StallDetector(object):
+    """
+    Detects stalls in a stream of (wall time, media time) samples, such as
+    VideoPuppeteer snapshots or in-page sampler events, in constant time per
+    sample.
+
+    Playback stalls when media time does not advance for at least
+    `min_stall` seconds of wall time while the video is meant to be
+    playing; time spent paused, seeking or ended is not counted at all.
+    When samples are sparse, a stall may begin and end between two of
+    them; it is then detected from media time falling behind wall time by
+    at least `min_stall` seconds.
+    After a stall, playback has recovered once media time has advanced
+    steadily, at no less than 90% of the playback rate, for `steady_time`
+    seconds.
+
+    Samples must all come from the same clock.
+
+    Inputs:
+        min_stall - Shortest interruption, in seconds, counted as a stall.
+        steady_time - Seconds of steady playback after which a stall is
+            over.
+        playback_rate - playbackRate of the video element.
+    """
+    def __init__(self, min_stall=0.5, steady_time=2, playback_rate=1):
+        self.min_stall = min_stall
+        self.steady_time = steady_time
+        self.playback_rate = playback_rate
+        self.stalls = []
+        self.play_time = 0
+        self.stall_time = 0
+        self._last = None
+        self._last_wall_time = None
+        # wall time of the earliest sample since which media time has stood
+        # still, while not yet long enough to be a stall
+        self._still_since = None
+        # wall time since which playback has been steady after a stall
+        self._steady_since = None
+
+    @property
+    def stalled(self):
+        return bool(self.stalls) and self.stalls[-1].end is None
+
+    def add_sample(self, wall_time, media_time, paused=False, ended=False,
+                   seeking=False, waiting=False):
+        """
+        Account for the state of the video element at `wall_time`.
+
+        :param waiting: the element reported that it is waiting for data,
+            which starts a stall without waiting for min_stall to pass
+        """
+        self._last_wall_time = wall_time
+        last, self._last = self._last, (wall_time, media_time)
+        if paused or ended or seeking:
+            # the next interval starts with the next sample
+            self._last = None
+        if last is None or self._last is None:
+            self._still_since = None
+            return
+        last_wall_time, last_media_time = last
+        elapsed = wall_time - last_wall_time
+        progress = media_time - last_media_time
+        if elapsed <= 0:
+            return
+        self.play_time += elapsed
+        if progress <= 0:
+            self._steady_since = None
+            if self.stalled:
+                self.stall_time += elapsed
+                return
+            if self._still_since is None:
+                self._still_since = last_wall_time
+            if waiting or wall_time - self._still_since >= self.min_stall:
+                self.stall_time += wall_time - self._still_since
+                self.stalls.append(Stall(self._still_since, None, media_time,
+                                         None))
+            return
+        self._still_since = None
+        rate = float(self.playback_rate)
+        if self.stalled:
+            # media time has been advancing since some point after the last
+            # sample
+            resumed = max(last_wall_time, wall_time - progress / rate)
+            self.stall_time += resumed - last_wall_time
+            self.stalls[-1] = self.stalls[-1]._replace(end=resumed)
+            self._steady_since = resumed
+            return
+        deficit = elapsed - progress / rate
+        if deficit >= self.min_stall:
+            # playback stalled and resumed between samples; when exactly is
+            # unknown, so place the stall at the start of the interval
+            self.stall_time += deficit
+            self.stalls.append(Stall(last_wall_time, last_wall_time + deficit,
+                                     last_media_time, None))
+            self._steady_since = last_wall_time + deficit
+            return
+        if not self.stalls or self.stalls[-1].time_to_recover is not None:
+            return
+        if progress / elapsed < 0.9 * rate:
+            self._steady_since = wall_time
+            return
+        if self._steady_since is None:
+            self._steady_since = last_wall_time
+        if wall_time - self._steady_since >= self.steady_time:
+            stall = self.stalls[-1]
+            self.stalls[-1] = stall._replace(
+                time_to_recover=self._steady_since - stall.start)
+
+    def add_events(self, events):
+        """
+        Account for PlaybackEvents drained from a PlaybackSampler.
+        """
+        for event in events:
+            if event.type == 'ratechange' and event.detail[0]:
+                self.playback_rate = event.detail[0]
+            elif event.type in ('timeupdate', 'waiting', 'playing'):
+                self.add_sample(event.time, event.current_time,
+                                waiting=(event.type == 'waiting'))
+
+    @property
+    def rebuffer_ratio(self):
+        """ Fraction of the time meant for playback that was spent stalled.
+        """
+        if not self.play_time:
+            return 0
+        return self.stall_time / self.play_time
+
+    def summary(self):
+        """
+        :return: dict of QoE metrics: stall_count, stall_durations (None for
+            an ongoing stall), total_stall_time, rebuffer_ratio and
+            time_to_recover (per stall, None if not recovered)
+        """
+        return {
+            'stall_count': len(self.stalls),
+            'stall_durations': [stall.duration for stall in self.stalls],
+            'total_stall_time': self.stall_time,
+            'rebuffer_ratio': self.rebuffer_ratio,
+            'time_to_recover': [stall.time_to_recover
+                                for stall in self.stalls],
+        }
+
+    def violations(self, max_stalls=None, max_stall_duration=None,
+                   max_rebuffer_ratio=None):
+        """
+        :return: list of messages, one per threshold that was exceeded;
+            thresholds that are None are not checked
+        """
+        messages = []
+        if max_stalls is not None and len(self.stalls) > max_stalls:
+            messages.append('%s stalls (at most %s allowed)' %
+                            (len(self.stalls), max_stalls))
+        if max_stall_duration is not None:
+            # an ongoing stall lasts until the last sample
+            longest = max([(stall.end or self._last_wall_time) - stall.start
+                           for stall in self.stalls] or [0])
+            if longest > max_stall_duration:
+                messages.append('stall of %.1f s (at most %s s allowed)' %
+                                (longest, max_stall_duration))
+        if (max_rebuffer_ratio is not None and
+                self.rebuffer_ratio > max_rebuffer_ratio):
+            messages.append('rebuffer ratio %.3f (at most %s allowed)' %
+                            (self.rebuffer_ratio, max_rebuffer_ratio))
+        return messages
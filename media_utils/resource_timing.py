@@ -0,0 +1,174 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+from collections import namedtuple
+import re
+
+# initiatorType of the resource timing entries of media data: MSE players
+# fetch segments with XHR or fetch, plain <video src> loads show up as
+# 'video', 'audio' or 'other'
+media_initiators = ('xmlhttprequest', 'fetch', 'video', 'audio', 'other')
+
+# urls of media files and segments, such as YouTube's videoplayback requests
+_media_url = re.compile(
+    r'\.(?:mp4|m4[asv]|webm|mkv|ts|og[agv]|opus|mp3|aac|flac|cmf[av])'
+    r'(?:[?#]|$)|/videoplayback\b|[?&]mime=(?:video|audio)', re.IGNORECASE)
+
+
+def is_media_fetch(url, initiator, content_type=None):
+    """
+    Return True if a resource timing entry looks like a fetch of media data
+    rather than of, say, an API or analytics endpoint: loads by a media
+    element always do, other initiators only if their url or content type
+    looks like media.
+    """
+    if initiator in ('video', 'audio'):
+        return True
+    if initiator not in media_initiators:
+        return False
+    if content_type and content_type.startswith(('video/', 'audio/')):
+        return True
+    return bool(_media_url.search(url))
+
+
+class SegmentFetch(namedtuple('SegmentFetch', [
+        'url', 'initiator', 'start', 'response_start', 'end', 'size'])):
+    """
+    One media fetch of the page, from its PerformanceResourceTiming entry.
+
+    start, response_start, end - wall times, by the puppeteer's clock, at
+        which the request started, its first byte arrived and its last byte
+        arrived.
+    size - bytes received (transferSize, or encodedBodySize when served from
+        cache), or 0 when the browser hides them, as for cross-origin
+        resources without a Timing-Allow-Origin header.
+    """
+    __slots__ = ()
+
+    @property
+    def duration(self):
+        return self.end - self.start
+
+    @property
+    def throughput(self):
+        """ kbps while receiving the response, or None if unknown. """
+        receiving = self.end - self.response_start
+        if not self.size or receiving <= 0:
+            return None
+        return self.size * 8 / 1000.0 / receiving
+
+
+class ResourceTimingLog(object):
+    """
+    Media fetches of a page, collected in bulk from its resource timing
+    entries with resource_timing_script.
+
+    Each fetch is assumed to receive its bytes evenly from response_start to
+    end, from which the throughput actually delivered over any interval can
+    be derived, to line up with playback samples.
+
+    Inputs:
+        url - The URL of the page containing the video element.
+    """
+    def __init__(self, url):
+        self.url = url
+        self.fetches = []
+        # index of the first entry not collected yet
+        self.next_index = 0
+        # resourcetimingbufferfull events seen in the page, during which
+        # entries may have been dropped
+        self.buffer_full = 0
+
+    def __len__(self):
+        return len(self.fetches)
+
+    def add(self, result, before, after):
+        """
+        Add the media fetches in `result`, as returned by
+        resource_timing_script between wall times `before` and `after`,
+        leaving out entries that do not pass is_media_fetch.
+
+        :return: list of the new SegmentFetches
+        """
+        if not result:
+            return []
+        self.next_index = result['next']
+        self.buffer_full = max(self.buffer_full,
+                               result.get('buffer_full') or 0)
+        # page time (ms since navigation) -> wall time, assuming the script
+        # ran halfway through the round trip
+        offset = (before + after) / 2.0 - result['now'] / 1000.0
+        fetches = [SegmentFetch(url, initiator, offset + start / 1000.0,
+                                offset + (response_start or start) / 1000.0,
+                                offset + end / 1000.0, size or 0)
+                   for url, initiator, start, response_start, end, size,
+                   content_type in result['entries']
+                   if is_media_fetch(url, initiator, content_type)]
+        self.fetches.extend(fetches)
+        return fetches
+
+    def throughput(self, start, end):
+        """
+        Return kbps delivered from wall time `start` to `end`, counting
+        fetches of unknown size as nothing.
+        """
+        if end <= start:
+            return None
+        received = 0
+        for fetch in self.fetches:
+            receiving = fetch.end - fetch.response_start
+            overlap = (min(end, fetch.end) -
+                       max(start, fetch.response_start))
+            if overlap <= 0 or not fetch.size:
+                continue
+            received += fetch.size * (overlap / receiving if receiving > 0
+                                      else 1)
+        return received * 8 / 1000.0 / (end - start)
+
+    def busy(self, start, end):
+        """
+        Return the fraction of wall time from `start` to `end` during which
+        at least one fetch was in flight. Low throughput while busy points
+        at the network; low throughput while idle means the player did not
+        ask for more data.
+
+        Fetches of unknown size are left out, as they are of throughput,
+        since they may not be media data after all.
+        """
+        if end <= start:
+            return None
+        spans = sorted((max(start, fetch.start), min(end, fetch.end))
+                       for fetch in self.fetches
+                       if fetch.size and fetch.start < end and
+                       fetch.end > start)
+        covered = 0
+        covered_until = start
+        for span_start, span_end in spans:
+            span_start = max(span_start, covered_until)
+            if span_end > span_start:
+                covered += span_end - span_start
+                covered_until = span_end
+        return covered / float(end - start)
+
+    def series(self, wall_times):
+        """
+        Return a list of (throughput, busy) for each interval between
+        consecutive `wall_times`, such as the wall times of playback
+        samples, with (None, None) for the first one.
+        """
+        result = [(None, None)] if wall_times else []
+        for start, end in zip(wall_times, wall_times[1:]):
+            result.append((self.throughput(start, end),
+                           self.busy(start, end)))
+        return result
+
+    def to_dict(self):
+        sizes = [fetch.size for fetch in self.fetches]
+        return {
+            'url': self.url,
+            'fetch_count': len(self.fetches),
+            'total_bytes': sum(sizes),
+            'buffer_full': self.buffer_full,
+            'fetches': [list(fetch) for fetch in self.fetches],
+        }
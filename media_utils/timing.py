@@ -0,0 +1,134 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+from collections import OrderedDict
+import ctypes
+import ctypes.util
+import os
+import time
+
+
+def _clock_gettime_monotonic():
+    """
+    Return a function reading CLOCK_MONOTONIC through libc, or None if that
+    is not available.
+    """
+    class timespec(ctypes.Structure):
+        _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6',
+                           use_errno=True)
+        clock_gettime = libc.clock_gettime
+    except (OSError, AttributeError):
+        return None
+    clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(timespec)]
+    # CLOCK_MONOTONIC on Linux
+    clock_id = 1
+
+    def monotonic():
+        t = timespec()
+        if clock_gettime(clock_id, ctypes.pointer(t)) != 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno))
+        return t.tv_sec + t.tv_nsec * 1e-9
+
+    return monotonic
+
+
+if hasattr(time, 'monotonic'):
+    monotonic = time.monotonic
+elif os.name == 'posix' and os.uname()[0] == 'Linux':
+    monotonic = _clock_gettime_monotonic() or time.time
+elif os.name == 'nt':
+    # On Windows, time.clock reads QueryPerformanceCounter, which is
+    # monotonic; elsewhere it is processor time.
+    monotonic = time.clock
+else:
+    # Nothing else in Python 2 is better than wall time here.
+    monotonic = time.time
+
+
+class MonotonicClock(object):
+    """
+    Clock for VideoPuppeteer and marionette_driver's Wait that is not
+    affected by changes to the system time.
+
+    `now` is in seconds from an arbitrary starting point, so only
+    differences between readings are meaningful.
+    """
+    @property
+    def now(self):
+        return monotonic()
+
+    def sleep(self, duration):
+        time.sleep(max(duration, 0))
+
+
+class TimingMarks(object):
+    """
+    Named points in time during the life of a VideoPuppeteer, read from its
+    clock.
+
+    Each mark is set once, when it is first reached; later calls to `mark`
+    with the same name are ignored.
+
+    The marks a VideoPuppeteer sets, in order, are:
+        navigate_start - before navigating to the page
+        element_present - when the video element was found
+        first_frame - when the element first had a frame to show
+            (readyState >= HAVE_CURRENT_DATA or decoded frames)
+        playback_started - when currentTime first exceeded 0
+        playback_done - when playback was found to be done
+    """
+    # name of interval -> (start mark, end mark)
+    intervals = OrderedDict([
+        ('element_latency', ('navigate_start', 'element_present')),
+        ('time_to_first_frame', ('navigate_start', 'first_frame')),
+        ('startup_latency', ('navigate_start', 'playback_started')),
+        ('playback_time', ('playback_started', 'playback_done')),
+    ])
+
+    def __init__(self, clock):
+        self.clock = clock
+        self.marks = OrderedDict()
+
+    def __contains__(self, name):
+        return name in self.marks
+
+    def mark(self, name):
+        """ Record the current time as `name` unless it was already set. """
+        if name not in self.marks:
+            self.marks[name] = self.clock.now
+        return self.marks[name]
+
+    def between(self, start, end):
+        """
+        Return seconds from mark `start` to mark `end`, or None if either
+        is not set.
+        """
+        if start in self.marks and end in self.marks:
+            return self.marks[end] - self.marks[start]
+
+    @property
+    def time_to_first_frame(self):
+        return self.between(*self.intervals['time_to_first_frame'])
+
+    @property
+    def startup_latency(self):
+        return self.between(*self.intervals['startup_latency'])
+
+    def to_dict(self):
+        """
+        Return the marks, relative to the first one, and the intervals
+        between them.
+        """
+        origin = next(iter(self.marks.values()), 0)
+        return {
+            'marks': OrderedDict((name, t - origin)
+                                 for name, t in self.marks.items()),
+            'intervals': OrderedDict((name, self.between(*marks))
+                                     for name, marks
+                                     in self.intervals.items()),
+        }
@@ -2,11 +2,19 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
 
-from time import clock, sleep
+from collections import namedtuple
 
 from marionette_driver import By, expected, Wait
+from marionette_driver.errors import TimeoutException
 
+from abr import AbrTracker
+from debug_reader import DebugReaderLog
 from firefox_media_tests.utils import verbose_until
+from metrics import PlaybackMetrics
+from playback_sampler import PlaybackSampler
+from qoe import StallDetector
+from resource_timing import ResourceTimingLog
+from timing import MonotonicClock, TimingMarks
 
 
 # Adapted from
@@ -31,6 +39,328 @@ for (var i=0; i < tabbrowser.browsers.length; ++i) {
   }
 }"""
 
+# Returns mozDebugReaderData of the MediaSource attached to the video element
+# passed in as arguments[0], as a list of lines, or null if there is none.
+# Both mozMediaSourceObject and mozDebugReaderData are chrome-only, so this
+# must run in the content process with the system sandbox.
+element_debug_script = """
+var ms = arguments[0].mozMediaSourceObject;
+if (!ms) {
+  return null;
+}
+return ms.mozDebugReaderData.split("\\n");
+"""
+
+# Counts changes of the media resource of the video element passed in as
+# arguments[0], so that cached element properties can be invalidated.
+# Returns the current count.
+generation_script = """
+var video = arguments[0];
+var page = video.wrappedJSObject;
+if (page.__mediaTestGeneration === undefined) {
+  page.__mediaTestGeneration = 0;
+  var bump = function () {
+    page.__mediaTestGeneration++;
+  };
+  video.addEventListener("loadstart", bump);
+  video.addEventListener("emptied", bump);
+  new window.MutationObserver(bump).observe(
+    video, {attributes: true, attributeFilter: ["src"]});
+}
+return page.__mediaTestGeneration;
+"""
+
+# Grows the page's resource timing buffer from its default of a few hundred
+# entries, which a long playback outgrows, and counts resourcetimingbufferfull
+# events in page.__mediaTestBufferFull, growing the buffer again on each.
+# Run right after navigating, before the page fetches much media.
+resource_buffer_script = """
+var performance = window.performance;
+var page = window.wrappedJSObject;
+if (!page.__mediaTestBufferSize) {
+  page.__mediaTestBufferSize = 100000;
+  page.__mediaTestBufferFull = 0;
+  performance.setResourceTimingBufferSize(page.__mediaTestBufferSize);
+  performance.addEventListener("resourcetimingbufferfull", function () {
+    page.__mediaTestBufferFull++;
+    page.__mediaTestBufferSize *= 2;
+    performance.setResourceTimingBufferSize(page.__mediaTestBufferSize);
+  });
+}
+"""
+
+# Returns the resource timing entries of the page from index arguments[1] on
+# as {next: index of the next entry, now: page time (ms), entries: [[name,
+# initiatorType, startTime, responseStart, responseEnd, size, contentType],
+# ...], buffer_full: number of resourcetimingbufferfull events}, with times
+# in ms since navigation and contentType null where the browser does not
+# expose it. Starts over when the page has fewer entries, as after
+# navigating, and sets up the entry buffer as resource_buffer_script does if
+# that has not been run in this page.
+resource_timing_script = resource_buffer_script + """
+var entries = performance.getEntriesByType("resource");
+var start = arguments[1];
+if (entries.length < start) {
+  start = 0;
+}
+var rows = [];
+for (var i = start; i < entries.length; ++i) {
+  var e = entries[i];
+  rows.push([e.name, e.initiatorType, e.startTime, e.responseStart,
+             e.responseEnd, e.transferSize || e.encodedBodySize || 0,
+             e.contentType || null]);
+}
+return {next: entries.length, now: performance.now(), entries: rows,
+        buffer_full: page.__mediaTestBufferFull};
+"""
+
+# Gathers the state of the video element passed in as arguments[0] into
+# `state`. Keys match the field names of VideoSnapshot.
+video_state_script = """
+var video = arguments[0];
+var quality = video.getVideoPlaybackQuality();
+var ranges = video.wrappedJSObject.buffered;
+var buffered = [];
+for (var i = 0; i < ranges.length; ++i) {
+  buffered.push([ranges.start(i), ranges.end(i)]);
+}
+var state = {
+  current_time: video.wrappedJSObject.currentTime,
+  duration: video.wrappedJSObject.duration,
+  paused: video.wrappedJSObject.paused,
+  ended: video.wrappedJSObject.ended,
+  seeking: video.wrappedJSObject.seeking,
+  ready_state: video.wrappedJSObject.readyState,
+  network_state: video.wrappedJSObject.networkState,
+  playback_rate: video.wrappedJSObject.playbackRate,
+  video_width: video.wrappedJSObject.videoWidth,
+  video_height: video.wrappedJSObject.videoHeight,
+  buffered: buffered,
+  video_url: video.baseURI,
+  video_src: video.getAttribute('src'),
+  total_frames: quality["totalVideoFrames"],
+  dropped_frames: quality["droppedVideoFrames"],
+  corrupted_frames: quality["corruptedVideoFrames"],
+  generation: video.wrappedJSObject.__mediaTestGeneration,
+  page_time: performance.now()
+};
+"""
+
+snapshot_script = video_state_script + "return state;"
+
+# Sets playbackRate and defaultPlaybackRate of the video element passed in as
+# arguments[0] to arguments[1], and sets them again whenever the element
+# loads metadata or starts playing: loading resets playbackRate to
+# defaultPlaybackRate, and players such as YouTube's reset both.
+playback_rate_script = """
+var video = arguments[0];
+var page = video.wrappedJSObject;
+var rate = arguments[1];
+if (page.__mediaTestRate) {
+  video.removeEventListener("loadedmetadata", page.__mediaTestRate);
+  video.removeEventListener("play", page.__mediaTestRate);
+}
+page.__mediaTestRate = function () {
+  page.defaultPlaybackRate = rate;
+  page.playbackRate = rate;
+};
+video.addEventListener("loadedmetadata", page.__mediaTestRate);
+video.addEventListener("play", page.__mediaTestRate);
+page.__mediaTestRate();
+"""
+
+# Async script that resolves once the video element passed in as arguments[0]
+# fires `ended`, reaches arguments[1] (expected duration, in seconds) or lags
+# behind wall time by more than arguments[2] seconds (0: never), or after
+# arguments[4] seconds otherwise, with reason 'running'. arguments[3] is the
+# lag accumulated before this script started. Lag accrues at the
+# playbackRate the element reports at each check.
+completion_script = """
+var video = arguments[0];
+var page = video.wrappedJSObject;
+var expectedDuration = arguments[1];
+var stallWaitTime = arguments[2];
+var start = performance.now();
+var accruedLag = arguments[3];
+var lastCheck = start;
+var lastCurrentTime = page.currentTime;
+var done = false;
+var timer = null;
+var chunkTimer = null;
+function elapsed() {
+  return (performance.now() - start) / 1000;
+}
+function lag() {
+  var now = performance.now();
+  accruedLag += ((now - lastCheck) / 1000 -
+                 (page.currentTime - lastCurrentTime) /
+                 (page.playbackRate || 1));
+  lastCheck = now;
+  lastCurrentTime = page.currentTime;
+  return accruedLag;
+}
+function finish(reason) {
+  if (done) {
+    return;
+  }
+  done = true;
+  video.removeEventListener("ended", onEnded);
+  video.removeEventListener("timeupdate", check);
+  window.clearInterval(timer);
+  window.clearTimeout(chunkTimer);
+  marionetteScriptFinished({
+    reason: reason,
+    current_time: page.currentTime,
+    elapsed: elapsed(),
+    lag: lag()
+  });
+}
+function onEnded() {
+  finish("ended");
+}
+function check() {
+  // accrue lag at every check, as the rate may change between them
+  var currentLag = lag();
+  if (page.ended) {
+    finish("ended");
+  } else if (page.currentTime >= expectedDuration) {
+    finish("duration");
+  } else if (stallWaitTime && currentLag > stallWaitTime) {
+    finish("stalled");
+  }
+}
+video.addEventListener("ended", onEnded);
+video.addEventListener("timeupdate", check);
+// timeupdate stops firing during a stall, so also check on a timer
+timer = window.setInterval(check, 250);
+chunkTimer = window.setTimeout(function () {
+  finish("running");
+}, arguments[4] * 1000);
+check();
+"""
+
+# Async script that resolves with the currentTime of the video element passed
+# in as arguments[0] once it exceeds arguments[1], or with null after
+# arguments[2] seconds.
+start_script = """
+var video = arguments[0];
+var page = video.wrappedJSObject;
+var startTime = arguments[1];
+var done = false;
+var timer = null;
+function finish(result) {
+  if (done) {
+    return;
+  }
+  done = true;
+  video.removeEventListener("timeupdate", check);
+  video.removeEventListener("playing", check);
+  window.clearTimeout(timer);
+  marionetteScriptFinished(result);
+}
+function check() {
+  if (page.currentTime > startTime) {
+    finish(page.currentTime);
+  }
+}
+video.addEventListener("timeupdate", check);
+video.addEventListener("playing", check);
+timer = window.setTimeout(function () {
+  finish(null);
+}, arguments[2] * 1000);
+check();
+"""
+
+
+class VideoSnapshot(namedtuple('VideoSnapshot', [
+        'current_time', 'duration', 'paused', 'ended', 'seeking',
+        'ready_state', 'network_state', 'playback_rate', 'video_width',
+        'video_height', 'buffered', 'video_url', 'video_src', 'total_frames',
+        'dropped_frames', 'corrupted_frames', 'generation',
+        'expected_duration', 'start_time', 'start_wall_time',
+        'lag_adjustment', 'wall_time'])):
+    """
+    Immutable record of the state of a video element at one point in time,
+    as returned by VideoPuppeteer.snapshot().
+
+    Element fields are gathered in a single script call; expected_duration,
+    start_time, start_wall_time, lag_adjustment and wall_time are copied
+    from the puppeteer when the snapshot is taken, so that derived values
+    like lag and remaining_time can be computed without further calls.
+    wall_time is when the page read the element, on the puppeteer's clock,
+    so that a slow round trip does not look like a stall.
+    lag_adjustment makes up for the playback before the last change of
+    playbackRate, which lag otherwise divides by the current rate.
+
+    generation counts how many times the element changed its media resource
+    (see generation_script).
+    """
+    __slots__ = ()
+
+    @property
+    def remaining_time(self):
+        # Note that self.current_time could temporarily refer to a
+        # spliced-in ad
+        return self.expected_duration - self.current_time
+
+    @property
+    def buffered_ahead(self):
+        """ Seconds buffered past current_time. """
+        for start, end in self.buffered:
+            if start <= self.current_time <= end:
+                return end - self.current_time
+        return 0
+
+    @property
+    def lag(self):
+        # media time advances playback_rate times faster than wall time
+        rate = float(self.playback_rate or 1)
+        elapsed_current_time = (self.current_time - self.start_time) / rate
+        elapsed_wall_time = self.wall_time - self.start_wall_time
+        return (elapsed_wall_time - elapsed_current_time +
+                self.lag_adjustment)
+
+    @staticmethod
+    def element_fields(state):
+        """
+        Normalize a dict produced by video_state_script into keyword
+        arguments for the element fields of a snapshot.
+        """
+        return {
+            'current_time': state.get('current_time') or 0,
+            'duration': state.get('duration') or 0,
+            'paused': state.get('paused'),
+            'ended': state.get('ended'),
+            'seeking': state.get('seeking'),
+            'ready_state': state.get('ready_state'),
+            'network_state': state.get('network_state'),
+            'playback_rate': state.get('playback_rate'),
+            'video_width': state.get('video_width'),
+            'video_height': state.get('video_height'),
+            'buffered': tuple(tuple(r) for r in state.get('buffered') or []),
+            'video_url': state.get('video_url'),
+            'video_src': state.get('video_src'),
+            'total_frames': state.get('total_frames'),
+            'dropped_frames': state.get('dropped_frames') or 0,
+            'corrupted_frames': state.get('corrupted_frames') or 0,
+            'generation': state.get('generation') or 0,
+        }
+
+
+class PlaybackSummary(namedtuple('PlaybackSummary', [
+        'reason', 'current_time', 'elapsed', 'lag', 'finished_at'])):
+    """
+    Outcome of VideoPuppeteer.wait_for_playback_end().
+
+    reason - 'ended' if the element fired `ended`, 'duration' if it reached
+        expected_duration, 'stalled' if lag exceeded stall_wait_time.
+    current_time - currentTime of the element when the wait resolved.
+    elapsed - seconds spent waiting, by the page's clock.
+    lag - lag of the element when the wait resolved.
+    finished_at - wall time at which the result was received.
+    """
+    __slots__ = ()
+
 
 class VideoPuppeteer(object):
     """
@@ -55,22 +385,74 @@ class VideoPuppeteer(object):
         stall_wait_time - The amount of time to wait to see if a stall has
             cleared. If 0, do not check for stalls.
         timeout - The amount of time to wait until the video starts.
+        playback_rate - The playbackRate to set on the video element. Lag,
+            stall detection and expected_wall_duration follow the rate the
+            element reports in snapshots, which pages may reset.
+        clock - Provides wall time (`now`) and waiting (`sleep`) for this
+            puppeteer and its Waits, like timing.MonotonicClock, which is
+            the default.
+        debug_interval - When set to >0, mozDebugReaderData is captured
+            into `debug_log`, a DebugReaderLog, with the first snapshot
+            taken at least this many seconds after the previous capture.
+        resource_interval - When set to >0, the page's media fetches are
+            collected from its resource timing entries into `resources`, a
+            ResourceTimingLog, in the same way.
+
+    Startup and completion times are recorded in `marks`, a TimingMarks.
+    Once playback has started, stalls seen in snapshots are recorded in
+    `qoe`, a StallDetector, and resolution changes in `abr`, an AbrTracker.
+
+    Properties in `_static_fields`, which only change along with the media
+    resource, are cached. Every snapshot refreshes them and drops those
+    cached before the element last changed resource, as counted by
+    generation_script. Cached values are read again once they are older
+    than `interval`, so waiting on one of them without taking snapshots
+    still sees it change.
     """
+    # Properties that only change along with the media resource
+    _static_fields = ('video_url', 'video_src')
+
     def __init__(self, marionette, url, video_selector='video', interval=1,
-                 set_duration=0, stall_wait_time=0, timeout=60):
+                 set_duration=0, stall_wait_time=0, timeout=60,
+                 playback_rate=1, clock=None, debug_interval=0,
+                 resource_interval=0):
         self.marionette = marionette
+        self.clock = clock or MonotonicClock()
+        self.marks = TimingMarks(self.clock)
         self.test_url = url
         self.interval = interval
+        self.playback_rate = playback_rate
+        self.requested_playback_rate = playback_rate
         self.stall_wait_time = stall_wait_time
         self.timeout = timeout
         self._set_duration = set_duration
         self.video = None
+        self.sampler = None
+        # static field -> (value, wall time when read)
+        self._static = {}
+        self._generation = None
+        # wall time at which the page's performance.now() was 0
+        self._page_origin = None
+        self.qoe = StallDetector(playback_rate=playback_rate)
+        self.abr = AbrTracker()
+        self.debug_interval = debug_interval
+        self.debug_log = DebugReaderLog(url)
+        self._last_debug_capture = None
+        self.resource_interval = resource_interval
+        self.resources = ResourceTimingLog(url)
+        self._last_resource_capture = None
+        self.metrics = PlaybackMetrics(url, marks=self.marks, qoe=self.qoe,
+                                       resources=self.resources,
+                                       abr=self.abr)
         self.expected_duration = 0
         self._start_time = 0
         self._start_wall_time = 0
-        wait = Wait(self.marionette, timeout=self.timeout)
+        self._lag_adjustment = 0
+        wait = Wait(self.marionette, timeout=self.timeout, clock=self.clock)
         with self.marionette.using_context('content'):
+            self.marks.mark('navigate_start')
             self.marionette.navigate(self.test_url)
+            self.marionette.execute_script(resource_buffer_script)
             self.marionette.execute_script("""
                 log('URL: {0}');""".format(self.test_url))
             verbose_until(wait, self,
@@ -86,15 +468,34 @@ class VideoPuppeteer(object):
                                                           'elements found.')
                 return
             self.video = videos_found[0]
+            self.marks.mark('element_present')
             self.marionette.execute_script("log('video element obtained');")
+            self._generation = self.execute_video_script(generation_script)
+            if self.playback_rate != 1:
+                self.set_playback_rate(self.playback_rate)
             # To get an accurate expected_duration, playback must have started
-            wait = Wait(self, timeout=self.timeout)
-            verbose_until(wait, self, lambda v: v.current_time > 0,
+            wait = Wait(self, timeout=self.timeout, clock=self.clock)
+            verbose_until(wait, self, lambda v: v._startup_progress(),
                           "Check if video current_time > 0")
             self._start_time = self.current_time
-            self._start_wall_time = clock()
+            self._start_wall_time = self.clock.now
             self.update_expected_duration()
 
+    def _startup_progress(self):
+        """
+        Return True once current_time exceeds 0, setting the first_frame and
+        playback_started marks as they are reached.
+        """
+        state = self.snapshot()
+        # HAVE_CURRENT_DATA
+        if (state.ready_state or 0) >= 2 or state.total_frames:
+            self.marks.mark('first_frame')
+        if state.current_time > 0:
+            self.marks.mark('first_frame')
+            self.marks.mark('playback_started')
+            return True
+        return False
+
     def update_expected_duration(self):
         """
         Update the duration of the target video at self.test_url (in seconds).
@@ -119,10 +520,225 @@ class VideoPuppeteer(object):
         else:
             self.expected_duration = video_duration
 
+    @property
+    def expected_wall_duration(self):
+        """
+        How long playing expected_duration seconds of video should take in
+        wall-clock seconds, at self.playback_rate.
+        """
+        return self.expected_duration / float(self.playback_rate)
+
+    @property
+    def max_wall_duration(self):
+        """
+        Upper bound on expected_wall_duration for the rest of playback, in
+        case the page resets a rate above 1 to normal speed.
+        """
+        return self.expected_duration / min(float(self.playback_rate), 1)
+
+    def set_playback_rate(self, rate):
+        """
+        Set playbackRate and defaultPlaybackRate of the video element, and
+        keep setting them whenever it loads new media or starts playing.
+        """
+        self.execute_video_script(playback_rate_script, script_args=[rate])
+        self.requested_playback_rate = rate
+        self._update_playback_rate(rate)
+
+    def _update_playback_rate(self, rate, current_time=None):
+        """
+        Follow the playbackRate the video element reports at `current_time`,
+        counting the playback since start as done at the previous rate.
+        """
+        if self._start_wall_time and current_time is not None:
+            elapsed = current_time - self._start_time
+            self._lag_adjustment += (elapsed / float(rate) -
+                                     elapsed / float(self.playback_rate))
+        if rate != self.requested_playback_rate:
+            self.marionette.log('%s: playbackRate is %s instead of %s' %
+                                (type(self).__name__, rate,
+                                 self.requested_playback_rate),
+                                level='WARNING')
+        self.playback_rate = rate
+        self.qoe.playback_rate = rate
+
     def get_debug_lines(self):
-        with self.marionette.using_context('chrome'):
-            debug_lines = self.marionette.execute_script(debug_script)
-        return debug_lines
+        """
+        Return mozDebugReaderData of the watched video element as a list of
+        lines, or None if it has no MediaSource. Unlike debug_script, this
+        only queries that element, from the content process.
+        """
+        with self.marionette.using_context('content'):
+            return self.marionette.execute_script(element_debug_script,
+                                                  script_args=[self.video],
+                                                  sandbox='system')
+
+    def capture_debug_data(self):
+        """
+        Capture mozDebugReaderData into self.debug_log.
+
+        :return: the parsed data, as returned by
+            debug_reader.parse_debug_lines, or None if there was none
+        """
+        self._last_debug_capture = self.clock.now
+        debug_lines = self.get_debug_lines()
+        if debug_lines:
+            return self.debug_log.add(self._last_debug_capture, debug_lines)
+
+    def capture_resource_timing(self):
+        """
+        Collect the media fetches of the page since the last call into
+        self.resources.
+
+        :return: list of the new SegmentFetches
+        """
+        before = self.clock.now
+        result = self.execute_video_script(
+            resource_timing_script, script_args=[self.resources.next_index])
+        self._last_resource_capture = after = self.clock.now
+        buffer_full = self.resources.buffer_full
+        fetches = self.resources.add(result, before, after)
+        if self.resources.buffer_full > buffer_full:
+            self.marionette.log('%s: resource timing buffer was full %s '
+                                'times; fetches may be missing' %
+                                (type(self).__name__,
+                                 self.resources.buffer_full),
+                                level='WARNING')
+        return fetches
+
+    def snapshot(self, capture=True):
+        """
+        Return a VideoSnapshot of the video element, gathered with a single
+        script call.
+
+        :param capture: also run the debug and resource timing captures
+            that are due; pass False when only describing the element, so
+            that doing so makes no further calls
+        """
+        before = self.clock.now
+        state = self.execute_video_script(snapshot_script) or {}
+        return self._make_snapshot(VideoSnapshot,
+                                   VideoSnapshot.element_fields(state),
+                                   capture=capture,
+                                   wall_time=self._page_wall_time(
+                                       state.get('page_time'), before))
+
+    def _page_wall_time(self, page_time, before):
+        """
+        Map `page_time`, the page's performance.now() in milliseconds during
+        a script call that started at wall time `before`, onto self.clock.
+        Return the current wall time if there is no `page_time`.
+        """
+        now = self.clock.now
+        if page_time is None:
+            return now
+        if self._page_origin is None:
+            # assuming the script ran halfway through the round trip, as
+            # PlaybackSampler does
+            self._page_origin = (before + now) / 2.0 - page_time / 1000.0
+        wall_time = self._page_origin + page_time / 1000.0
+        # The script ran during the round trip: if the mapping says
+        # otherwise, the first guess was off or the page was reloaded, so
+        # move the origin as little as needed.
+        if wall_time < before:
+            self._page_origin += before - wall_time
+            wall_time = before
+        elif wall_time > now:
+            self._page_origin -= wall_time - now
+            wall_time = now
+        return wall_time
+
+    def _make_snapshot(self, snapshot_class, fields, capture=True,
+                       wall_time=None):
+        """
+        Create a `snapshot_class` instance from element `fields` and the
+        current state of this puppeteer, and record it in self.metrics,
+        self.qoe and self.abr once playback has started. If `capture` is
+        True, also run the captures that are due. `wall_time` defaults to
+        now.
+        """
+        rate = fields.get('playback_rate')
+        if rate and rate != self.playback_rate:
+            self._update_playback_rate(rate, fields.get('current_time'))
+        state = snapshot_class(expected_duration=self.expected_duration,
+                               start_time=self._start_time,
+                               start_wall_time=self._start_wall_time,
+                               lag_adjustment=self._lag_adjustment,
+                               wall_time=(self.clock.now if wall_time is None
+                                          else wall_time),
+                               **fields)
+        self._update_static(state)
+        if self._start_wall_time:
+            self.metrics.record(state)
+            self._record_qoe(state)
+            self._record_abr(state)
+            if capture:
+                self._run_captures(state)
+        return state
+
+    def _update_static(self, state):
+        """
+        Cache the static fields of `state`, a snapshot, dropping cached
+        values from before the last change of media resource.
+        """
+        if state.generation != self._generation:
+            self._static = {}
+            self._generation = state.generation
+        for name in self._static_fields:
+            if name in state._fields:
+                self._static[name] = (getattr(state, name), state.wall_time)
+
+    def _static_value(self, name, fetch):
+        """
+        Return the cached value of static property `name`, calling `fetch`
+        to read it if it is not cached or older than self.interval.
+        """
+        cached = self._static.get(name)
+        if cached is None or self.clock.now - cached[1] > self.interval:
+            cached = self._static[name] = (fetch(), self.clock.now)
+        return cached[0]
+
+    def _run_captures(self, state):
+        """
+        Capture mozDebugReaderData and resource timing entries if their
+        interval has passed since their last capture, as of `state`.
+        """
+        if self.debug_interval and (
+                self._last_debug_capture is None or
+                state.wall_time - self._last_debug_capture >=
+                self.debug_interval):
+            self.capture_debug_data()
+        if self.resource_interval and (
+                self._last_resource_capture is None or
+                state.wall_time - self._last_resource_capture >=
+                self.resource_interval):
+            self.capture_resource_timing()
+
+    def _record_qoe(self, state):
+        """ Feed `state`, a snapshot, to self.qoe. """
+        self.qoe.add_sample(state.wall_time, state.current_time,
+                            paused=state.paused, ended=state.ended,
+                            seeking=state.seeking)
+
+    def _record_abr(self, state):
+        """ Feed the resolution of `state`, a snapshot, to self.abr. """
+        level = None
+        if state.video_width and state.video_height:
+            level = '%sx%s' % (state.video_width, state.video_height)
+        self.abr.add_sample(state.wall_time, state.current_time, level,
+                            state.video_height, state.buffered_ahead,
+                            state.dropped_frames,
+                            paused=(state.paused or state.ended or
+                                    state.seeking))
+
+    def start_sampler(self, **kwargs):
+        """
+        Install a PlaybackSampler on the video element and return it. Keyword
+        arguments are passed on to PlaybackSampler.
+        """
+        self.sampler = PlaybackSampler(self, **kwargs)
+        self.sampler.start()
+        return self.sampler
 
     def play(self):
         self.execute_video_script('arguments[0].wrappedJSObject.play();')
@@ -154,8 +770,10 @@ class VideoPuppeteer(object):
 
     @property
     def video_src(self):
-        with self.marionette.using_context('content'):
-            return self.video.get_attribute('src')
+        def fetch():
+            with self.marionette.using_context('content'):
+                return self.video.get_attribute('src')
+        return self._static_value('video_src', fetch)
 
     @property
     def total_frames(self):
@@ -177,77 +795,195 @@ class VideoPuppeteer(object):
 
     @property
     def video_url(self):
-        return self.execute_video_script('return arguments[0].baseURI;')
+        def fetch():
+            return self.execute_video_script('return arguments[0].baseURI;')
+        return self._static_value('video_url', fetch)
 
     @property
     def lag(self):
-        # Note that self.current_time could temporarily refer to a
-        # spliced-in ad
-        elapsed_current_time = self.current_time - self._start_time
-        elapsed_wall_time = clock() - self._start_wall_time
-        return elapsed_wall_time - elapsed_current_time
+        # Note that current_time could temporarily refer to a spliced-in ad.
+        # The snapshot divides by the playbackRate the element reports.
+        return self.snapshot(capture=False).lag
+
+    def wait_for_playback_start(self):
+        """
+        Block until current_time exceeds its value when the puppeteer was
+        created, using in-page events rather than polling.
+
+        :return: current_time once playback has started
+        :raises TimeoutException: if that does not happen within
+            self.timeout seconds
+        """
+        current_time = self.execute_async_video_script(
+            start_script, script_args=[self._start_time, self.timeout],
+            script_timeout=(self.timeout + 30) * 1000)
+        if current_time is None:
+            raise TimeoutException('Playback did not start within %s s\n%s' %
+                                   (self.timeout, self))
+        return current_time
+
+    def wait_for_playback_end(self, timeout, chunk=300):
+        """
+        Block until the video ends, reaches expected_duration or stalls,
+        using in-page events rather than polling.
+
+        The wait is split into script calls of at most `chunk` seconds each,
+        so that long videos do not run into Marionette's socket timeout.
+        Since no snapshots are taken meanwhile, a PlaybackSampler records
+        the element's events, which are drained into self.qoe after each
+        call.
+
+        :param timeout: maximum number of seconds to wait
+        :param chunk: maximum number of seconds to wait per script call
+        :return: PlaybackSummary
+        :raises VideoException: if lag exceeds self.stall_wait_time
+        :raises TimeoutException: if playback does not finish in time
+        """
+        deadline = self.clock.now + timeout
+        elapsed = 0
+        lag = self.lag
+        # timeupdate fires about 4 times per second
+        sampler = self.start_sampler(capacity=int(chunk * 8),
+                                     quality_interval=0)
+        try:
+            while True:
+                span = min(chunk, deadline - self.clock.now)
+                if span <= 0:
+                    raise TimeoutException('Playback did not finish within '
+                                           '%s s\n%s' % (timeout, self))
+                result = self.execute_async_video_script(
+                    completion_script,
+                    script_args=[self.expected_duration,
+                                 self.stall_wait_time, lag, span],
+                    script_timeout=(span + 30) * 1000)
+                elapsed += result['elapsed']
+                lag = result['lag']
+                self.qoe.add_events(sampler.drain())
+                if result['reason'] != 'running':
+                    break
+        finally:
+            sampler.stop()
+            self.sampler = None
+        self.marks.mark('playback_done')
+        summary = PlaybackSummary(reason=result['reason'],
+                                  current_time=result['current_time'],
+                                  elapsed=elapsed,
+                                  lag=result['lag'],
+                                  finished_at=self.clock.now)
+        if summary.reason == 'stalled':
+            raise VideoException('Video %s stalled.\n%s' %
+                                 (self.video_url, self))
+        return summary
 
     def measure_progress(self):
         initial = self.current_time
-        sleep(1)
+        self.clock.sleep(1)
         return self.current_time - initial
 
-    def execute_video_script(self, script):
+    def execute_video_script(self, script, script_args=()):
         """ Execute JS script in 'content' context with access to video element.
         :param script: script to be executed
         `arguments[0]` in script refers to video element.
+        :param script_args: further arguments, available to the script as
+            `arguments[1]` onwards.
         :return: value returned by script
         """
         with self.marionette.using_context('content'):
-            return self.marionette.execute_script(script,
-                                                  script_args=[self.video])
+            return self.marionette.execute_script(
+                script, script_args=[self.video] + list(script_args))
+
+    def execute_async_video_script(self, script, script_args=(),
+                                   script_timeout=None):
+        """ Execute async JS script in 'content' context with access to video
+        element.
+        :param script: script to be executed; it must call
+            `marionetteScriptFinished` with its result.
+        `arguments[0]` in script refers to video element.
+        :param script_args: further arguments, available to the script as
+            `arguments[1]` onwards.
+        :param script_timeout: timeout in milliseconds
+        :return: value passed to `marionetteScriptFinished` by script
+        """
+        with self.marionette.using_context('content'):
+            return self.marionette.execute_async_script(
+                script, script_args=[self.video] + list(script_args),
+                script_timeout=script_timeout)
 
-    def __str__(self):
+    def _state_messages(self, state):
+        """
+        Lines describing `state`, a snapshot of this puppeteer, for __str__.
+        """
         messages = ['%s - test url: %s: {' % (type(self).__name__,
                                               self.test_url)]
-        if self.video:
+        if state:
             messages += [
                 '\t(video)',
-                '\tcurrent_time: {0},'.format(self.current_time),
-                '\tduration: {0},'.format(self.duration),
-                '\texpected_duration: {0},'.format(self.expected_duration),
-                '\tlag: {0},'.format(self.lag),
-                '\turl: {0}'.format(self.video_url),
-                '\tsrc: {0}'.format(self.video_src),
-                '\tframes total: {0}'.format(self.total_frames),
-                '\t - dropped: {0}'.format(self.dropped_frames),
-                '\t - corrupted: {0}'.format(self.corrupted_frames)
+                '\tcurrent_time: {0},'.format(state.current_time),
+                '\tduration: {0},'.format(state.duration),
+                '\texpected_duration: {0},'.format(state.expected_duration),
+                '\tlag: {0},'.format(state.lag),
+                '\turl: {0}'.format(state.video_url),
+                '\tsrc: {0}'.format(state.video_src),
+                '\tframes total: {0}'.format(state.total_frames),
+                '\t - dropped: {0}'.format(state.dropped_frames),
+                '\t - corrupted: {0}'.format(state.corrupted_frames)
             ]
         else:
             messages += ['\tvideo: None']
         messages.append('}')
-        return '\n'.join(messages)
+        return messages
+
+    def __str__(self):
+        state = self.snapshot(capture=False) if self.video else None
+        return '\n'.join(self._state_messages(state))
 
 
 class VideoException(Exception):
     pass
 
 
-def playback_started(video):
+def playback_started(video, state=None):
+    """
+    Check whether playback has started.
+    :param video: VideoPuppeteer
+    :param state: optional VideoSnapshot of `video` to check against instead
+        of taking a new one.
+    """
     try:
-        return video.current_time > video._start_time
+        state = state or video.snapshot()
+        return state.current_time > state.start_time
     except Exception as e:
         print ('Got exception %s' % e)
         return False
 
 
-def playback_done(video):
+def playback_done(video, state=None, past_end=False):
+    """
+    Check whether playback is done, raising VideoException if it stalled.
+    :param video: VideoPuppeteer
+    :param state: optional VideoSnapshot of `video` to check against instead
+        of taking a new one.
+    :param past_end: also count playback as done once it has ended or gone
+        past expected_duration, for callers that may not poll `video` every
+        interval
+    """
+    state = state or video.snapshot()
     # If we are near the end and there is still a video element, then
     # we are essentially done. If this happens to be last time we are polled
     # before the video ends, we won't get another chance.
-    remaining_time = video.remaining_time
-    if abs(remaining_time) < video.interval:
+    remaining_time = state.remaining_time
+    window = video.interval * video.playback_rate
+    if past_end and (state.ended or remaining_time <= window):
+        video.marks.mark('playback_done')
+        return True
+    if abs(remaining_time) < window:
+        video.marks.mark('playback_done')
         return True
 
     # Check to see if the video has stalled. Accumulate the amount of lag
     # since the video started, and if it is too high, then raise.
-    if video.stall_wait_time and (video.lag > video.stall_wait_time):
-        raise VideoException('Video %s stalled.\n%s' % (video.video_url,
+    if video.stall_wait_time and (state.lag > video.stall_wait_time):
+        raise VideoException('Video %s stalled.\n%s' % (state.video_url,
                                                         video))
 
     # We are cruising, so we are not done.
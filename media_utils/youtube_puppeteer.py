@@ -2,21 +2,197 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
 
-from time import sleep
+from collections import namedtuple
 import re
 from json import loads
 
 from marionette_driver import By, expected, Wait
 from marionette_driver.errors import TimeoutException, NoSuchElementException
-from video_puppeteer import VideoPuppeteer, VideoException
+from video_puppeteer import (VideoPuppeteer, VideoException, VideoSnapshot,
+                             video_state_script)
 from firefox_media_tests.utils import verbose_until
 
 
+# Extends video_state_script with the state of the YouTube #movie_player
+# element passed in as arguments[1]. Keys match the field names of
+# YouTubeSnapshot.
+yt_snapshot_script = video_state_script + """
+var player = arguments[1].wrappedJSObject;
+var videoData = player.getVideoData() || {};
+var displayState = player.getOption("ad", "displaystate");
+state.player_state = player.getPlayerState();
+state.ad_state = player.getAdState();
+state.player_current_time = player.getCurrentTime();
+state.player_duration = player.getDuration();
+state.playback_quality = player.getPlaybackQuality();
+state.movie_id = videoData["video_id"];
+state.movie_title = videoData["title"];
+state.player_url = player.getVideoUrl();
+state.breaks_count = player.getOption("ad", "breakscount");
+state.ad_format = displayState ? displayState.adFormat : false;
+state.ad_skippable = displayState ? displayState.skippable : false;
+return state;
+"""
+
+
+# Async script that waits while an ad plays in the #movie_player element
+# passed in as arguments[1], whose video element is arguments[0]. If
+# arguments[2] is true, the skip button is clicked as soon as it is displayed.
+# If arguments[4] is true, the script also waits for the main video to have a
+# duration and not be buffering. Resolves with "skipped", "ended" (also if no
+# ad was playing) or "timeout" after arguments[3] seconds.
+ad_script = """
+var video = arguments[0];
+var playerElement = arguments[1];
+var player = playerElement.wrappedJSObject;
+var skip = arguments[2];
+var untilReady = arguments[4];
+var events = ["loadstart", "playing", "pause", "ended", "durationchange",
+              "timeupdate"];
+var done = false;
+function finish(result) {
+  if (done) {
+    return;
+  }
+  done = true;
+  observer.disconnect();
+  events.forEach(function (type) {
+    video.removeEventListener(type, check);
+  });
+  window.clearInterval(timer);
+  window.clearTimeout(timeout);
+  marionetteScriptFinished(result);
+}
+function check() {
+  // 1: PLAYING
+  if (player.getAdState() != 1) {
+    // 3: BUFFERING
+    if (!untilReady || (video.wrappedJSObject.duration &&
+                        player.getPlayerState() != 3)) {
+      finish("ended");
+    }
+    return;
+  }
+  if (skip) {
+    var button = playerElement.querySelector(".videoAdUiSkipContainer");
+    if (button && button.offsetWidth > 0 && button.offsetHeight > 0) {
+      button.click();
+      finish("skipped");
+    }
+  }
+}
+// The skip button is shown by changes to the player's subtree; ad and
+// player state changes come with events on the video element, or at worst
+// with the next tick of the timer.
+var observer = new window.MutationObserver(check);
+observer.observe(playerElement, {childList: true, subtree: true,
+                                 attributes: true,
+                                 attributeFilter: ["style", "class"]});
+events.forEach(function (type) {
+  video.addEventListener(type, check);
+});
+var timer = window.setInterval(check, 500);
+var timeout = window.setTimeout(function () {
+  finish("timeout");
+}, arguments[3] * 1000);
+check();
+"""
+
+
+class YouTubeSnapshot(namedtuple('YouTubeSnapshot', VideoSnapshot._fields + (
+        'player_state', 'ad_state', 'player_current_time', 'player_duration',
+        'playback_quality', 'movie_id', 'movie_title', 'player_url',
+        'breaks_count', 'ad_format', 'ad_skippable')), VideoSnapshot):
+    """
+    Immutable record of the state of a YouTube #movie_player element and its
+    video element, as returned by YouTubePuppeteer.snapshot().
+
+    All fields are gathered in a single script call.
+    """
+    __slots__ = ()
+
+    def _is_player_state(self, name):
+        return self.player_state == YouTubePuppeteer._yt_player_state[name]
+
+    def _is_ad_state(self, name):
+        return self.ad_state == YouTubePuppeteer._yt_player_state[name]
+
+    @property
+    def player_remaining_time(self):
+        return self.expected_duration - self.player_current_time
+
+    @property
+    def player_unstarted(self):
+        return self._is_player_state('UNSTARTED')
+
+    @property
+    def player_ended(self):
+        return self._is_player_state('ENDED')
+
+    @property
+    def player_playing(self):
+        return self._is_player_state('PLAYING')
+
+    @property
+    def player_paused(self):
+        return self._is_player_state('PAUSED')
+
+    @property
+    def player_buffering(self):
+        return self._is_player_state('BUFFERING')
+
+    @property
+    def player_cued(self):
+        return self._is_player_state('CUED')
+
+    @property
+    def ad_inactive(self):
+        return self.ad_ended or self._is_ad_state('UNSTARTED')
+
+    @property
+    def ad_playing(self):
+        return self._is_ad_state('PLAYING')
+
+    @property
+    def ad_ended(self):
+        return self._is_ad_state('ENDED')
+
+    @staticmethod
+    def player_fields(state):
+        """
+        Normalize a dict produced by yt_snapshot_script into keyword
+        arguments for the #movie_player fields of a snapshot.
+        """
+        title = state.get('movie_title')
+        if title is not None:
+            # title may include non-ascii characters; replace them to avoid
+            # UnicodeEncodeError in string formatting for log messages
+            title = title.encode('ascii', 'replace')
+        return {
+            'player_state': state.get('player_state'),
+            'ad_state': state.get('ad_state'),
+            'player_current_time': state.get('player_current_time') or 0,
+            'player_duration': state.get('player_duration') or 0,
+            'playback_quality': state.get('playback_quality'),
+            'movie_id': state.get('movie_id'),
+            'movie_title': title,
+            'player_url': state.get('player_url'),
+            # if video is not associated with any ads, breaks will be null
+            'breaks_count': state.get('breaks_count') or 0,
+            'ad_format': state.get('ad_format') or False,
+            'ad_skippable': state.get('ad_skippable') or False,
+        }
+
+
 class YouTubePuppeteer(VideoPuppeteer):
     """
     Wrapper around a YouTube #movie_player element
 
     Partial reference: https://developers.google.com/youtube/js_api_reference
+
+    Inputs:
+    ad_timeout: maximum number of seconds the constructor waits for any ads
+        to end before the main video's duration is read. Default 60.
     """
 
     _yt_player_state = {
@@ -28,15 +204,29 @@ class YouTubePuppeteer(VideoPuppeteer):
         'CUED': 5
     }
     _yt_player_state_name = {v: k for k, v in _yt_player_state.items()}
+    # playback quality -> video height
+    _yt_quality_height = {
+        'tiny': 144,
+        'small': 240,
+        'medium': 360,
+        'large': 480,
+        'hd720': 720,
+        'hd1080': 1080,
+        'hd1440': 1440,
+        'hd2160': 2160,
+        'highres': 4320
+    }
     _time_pattern = re.compile('(?P<minute>\d+):(?P<second>\d+)')
+    _static_fields = VideoPuppeteer._static_fields + (
+        'movie_id', 'movie_title', 'player_url')
 
-    def __init__(self, marionette, url, **kwargs):
+    def __init__(self, marionette, url, ad_timeout=60, **kwargs):
         self.player = None
         super(YouTubePuppeteer,
               self).__init__(marionette, url,
                              video_selector='#movie_player video',
                              **kwargs)
-        wait = Wait(self.marionette, timeout=30)
+        wait = Wait(self.marionette, timeout=30, clock=self.clock)
         with self.marionette.using_context('content'):
             verbose_until(wait, self,
                           expected.element_present(By.ID, 'movie_player'))
@@ -45,12 +235,17 @@ class YouTubePuppeteer(VideoPuppeteer):
                                            "element obtained');")
         # When an ad is playing, self.player_duration indicates the duration
         # of the spliced-in ad stream, not the duration of the main video, so
-        # we attempt to skip the ad first.
+        # we attempt to skip the ad first. Ads may come back to back, but we
+        # wait at most `ad_timeout` seconds for all of them together.
+        deadline = self.clock.now + ad_timeout
         for attempt in range(5):
-            sleep(1)
-            self.process_ad()
-            if (self.ad_inactive and self.duration and not
-                    self.player_buffering):
+            remaining = deadline - self.clock.now
+            if remaining <= 0:
+                self.marionette.log('Gave up waiting for ads after %s s' %
+                                    ad_timeout, level='WARNING')
+                break
+            self.process_ad(until_ready=True, timeout=remaining)
+            if self.snapshot().ad_inactive:
                 break
         self.update_expected_duration()
 
@@ -86,7 +281,7 @@ class YouTubePuppeteer(VideoPuppeteer):
         """ Playback progress in seconds via YouTube API.
         """
         initial = self.player_current_time
-        sleep(1)
+        self.clock.sleep(1)
         return self.player_current_time - initial
 
     def _get_player_debug_dict(self):
@@ -99,6 +294,54 @@ class YouTubePuppeteer(VideoPuppeteer):
                 self.marionette.log('Error loading json: DebugText',
                                     level='DEBUG')
 
+    def snapshot(self, capture=True):
+        """
+        Return a YouTubeSnapshot of the #movie_player element and its video
+        element, gathered with a single script call.
+
+        Until #movie_player is obtained, this is a plain VideoSnapshot.
+
+        :param capture: as for VideoPuppeteer.snapshot
+        """
+        if not self.player:
+            return super(YouTubePuppeteer, self).snapshot(capture=capture)
+        before = self.clock.now
+        state = self.execute_yt_script(yt_snapshot_script) or {}
+        fields = YouTubeSnapshot.element_fields(state)
+        fields.update(YouTubeSnapshot.player_fields(state))
+        return self._make_snapshot(YouTubeSnapshot, fields, capture=capture,
+                                   wall_time=self._page_wall_time(
+                                       state.get('page_time'), before))
+
+    def _record_qoe(self, state):
+        if not isinstance(state, YouTubeSnapshot):
+            return super(YouTubePuppeteer, self)._record_qoe(state)
+        # follow the main video through the player, leaving out ads
+        self.qoe.add_sample(state.wall_time, state.player_current_time,
+                            paused=(state.ad_playing or state.player_paused or
+                                    state.player_unstarted),
+                            ended=state.player_ended,
+                            seeking=state.seeking)
+
+    def _record_abr(self, state):
+        if not isinstance(state, YouTubeSnapshot):
+            return super(YouTubePuppeteer, self)._record_abr(state)
+        # the quality the player reports, falling back to the resolution of
+        # the video element, leaving out ads
+        quality = state.playback_quality
+        if quality in self._yt_quality_height:
+            level, rank = quality, self._yt_quality_height[quality]
+        elif state.video_width and state.video_height:
+            level = '%sx%s' % (state.video_width, state.video_height)
+            rank = state.video_height
+        else:
+            level = rank = None
+        self.abr.add_sample(state.wall_time, state.player_current_time, level,
+                            rank, state.buffered_ahead, state.dropped_frames,
+                            paused=(state.ad_playing or state.player_paused or
+                                    state.player_unstarted or
+                                    state.player_ended or state.seeking))
+
     def execute_yt_script(self, script):
         """ Execute JS script in 'content' context with access to video element and
         YouTube #movie_player element.
@@ -119,23 +362,24 @@ class YouTubePuppeteer(VideoPuppeteer):
 
     @property
     def movie_id(self):
-        return self.execute_yt_script('return arguments[1].'
-                                      'wrappedJSObject.'
-                                      'getVideoData()["video_id"];')
+        return self._static_value('movie_id', lambda: self.execute_yt_script(
+            'return arguments[1].wrappedJSObject.getVideoData()["video_id"];'))
 
     @property
     def movie_title(self):
-        title = self.execute_yt_script('return arguments[1].'
-                                       'wrappedJSObject.'
-                                       'getVideoData()["title"];')
-        # title may include non-ascii characters; replace them to avoid
-        # UnicodeEncodeError in string formatting for log messages
-        return title.encode('ascii', 'replace')
+        def fetch():
+            title = self.execute_yt_script('return arguments[1].'
+                                           'wrappedJSObject.'
+                                           'getVideoData()["title"];')
+            # title may include non-ascii characters; replace them to avoid
+            # UnicodeEncodeError in string formatting for log messages
+            return title.encode('ascii', 'replace')
+        return self._static_value('movie_title', fetch)
 
     @property
     def player_url(self):
-        return self.execute_yt_script('return arguments[1].'
-                                      'wrappedJSObject.getVideoUrl();')
+        return self._static_value('player_url', lambda: self.execute_yt_script(
+            'return arguments[1].wrappedJSObject.getVideoUrl();'))
 
     @property
     def player_state(self):
@@ -180,25 +424,11 @@ class YouTubePuppeteer(VideoPuppeteer):
 
         :return: integer representing ad format, or False
         """
-        state = self.get_ad_displaystate()
-        ad_format = False
-        if state:
-            with self.marionette.using_context('content'):
-                ad_format = self.marionette.execute_script("""
-                    return arguments[0].adFormat;""",
-                    script_args=[state])
-        return ad_format
+        return self.snapshot(capture=False).ad_format
 
     @property
     def ad_skippable(self):
-        state = self.get_ad_displaystate()
-        skippable = False
-        if state:
-            with self.marionette.using_context('content'):
-                skippable = self.marionette.execute_script("""
-                    return arguments[0].skippable;""",
-                    script_args=[state])
-        return skippable
+        return self.snapshot(capture=False).ad_skippable
 
     def get_ad_displaystate(self):
         # may return None
@@ -219,8 +449,7 @@ class YouTubePuppeteer(VideoPuppeteer):
 
     @property
     def ad_inactive(self):
-        return (self.ad_ended or
-                self.ad_state == self._yt_player_state['UNSTARTED'])
+        return self.snapshot(capture=False).ad_inactive
 
     @property
     def ad_playing(self):
@@ -230,60 +459,74 @@ class YouTubePuppeteer(VideoPuppeteer):
     def ad_ended(self):
         return self.ad_state == self._yt_player_state['ENDED']
 
-    def process_ad(self):
-        if self.attempt_ad_skip() or self.ad_inactive:
+    def wait_for_ad(self, timeout, skip=True, until_ready=False):
+        """
+        Block while an ad plays, using in-page observers rather than polling.
+
+        :param timeout: maximum number of seconds to wait
+        :param skip: click the skip button as soon as it is displayed
+        :param until_ready: also wait until the main video has a duration
+            and is not buffering
+        :return: 'skipped', 'ended' (also if no ad was playing) or 'timeout'
+        """
+        return self.execute_async_video_script(
+            ad_script, script_args=[self.player, skip, timeout, until_ready],
+            script_timeout=(timeout + 30) * 1000)
+
+    def process_ad(self, until_ready=False, timeout=None):
+        """
+        Wait for the ad that is playing, if any, to end, skipping it as soon
+        as possible.
+
+        :param until_ready: also wait until the main video has a duration
+            and is not buffering
+        :param timeout: optional upper bound on the wait, in seconds
+        """
+        state = self.snapshot()
+        if state.ad_inactive and (not until_ready or (
+                state.duration and not state.player_buffering)):
             return
-        ad_timeout = (self.search_ad_duration() or 30) + 5
-        wait = Wait(self, timeout=ad_timeout, interval=1)
-        try:
-            self.marionette.log('process_ad: waiting %s s for ad' % ad_timeout)
-            verbose_until(wait, self, lambda y: y.ad_ended, "Check if ad ended")
-        except TimeoutException:
+        ad_timeout = (self.search_ad_duration(state) or 30) + 5
+        if timeout is not None:
+            ad_timeout = min(ad_timeout, timeout)
+        self.marionette.log('process_ad: waiting up to %s s for ad' %
+                            ad_timeout)
+        result = self.wait_for_ad(ad_timeout, until_ready=until_ready)
+        if result == 'skipped':
+            self.marionette.log('Skipped ad.')
+        elif result == 'timeout':
             self.marionette.log('Waiting for ad to end timed out',
                                 level='WARNING')
 
-    def attempt_ad_skip(self):
+    def attempt_ad_skip(self, timeout=30):
         """
-        Attempt to skip ad by clicking on skip-add button.
+        Attempt to skip ad by clicking on skip-add button as soon as it is
+        displayed, waiting at most `timeout` seconds or until the ad ends.
         Return True if clicking of ad-skip button occurred.
         """
-        # Wait for ad to load and become skippable
-        if self.ad_playing:
-            self.marionette.log('Waiting while ad plays')
-            sleep(10)
-        else:
-            # no ad playing
+        if not self.ad_playing:
             return False
-        if self.ad_skippable:
-            selector = '#movie_player .videoAdUiSkipContainer'
-            wait = Wait(self.marionette, timeout=30)
-            try:
-                with self.marionette.using_context('content'):
-                    wait.until(expected.element_displayed(By.CSS_SELECTOR,
-                                                          selector))
-                    ad_button = self.marionette.find_element(By.CSS_SELECTOR,
-                                                             selector)
-                    ad_button.click()
-                    self.marionette.log('Skipped ad.')
-                    return True
-            except (TimeoutException, NoSuchElementException):
-                self.marionette.log('Could not obtain '
-                                    'element: %s' % selector,
-                                    level='WARNING')
+        if self.wait_for_ad(timeout) == 'skipped':
+            self.marionette.log('Skipped ad.')
+            return True
         return False
 
-    def search_ad_duration(self):
+    def search_ad_duration(self, state=None):
         """
+        :param state: optional YouTubeSnapshot to check against instead of
+            taking a new one.
         :return: ad duration in seconds, if currently displayed in player
         """
-        if not (self.ad_playing or self.player_measure_progress() == 0):
+        state = state or self.snapshot()
+        if not state.ad_playing:
             return None
         # If the ad is not Flash...
-        if (self.ad_playing and self.video_src.startswith('mediasource') and
-                self.duration):
-            return self.duration
+        if (state.ad_playing and
+                (state.video_src or '').startswith('mediasource') and
+                state.duration):
+            return state.duration
         selector = '#movie_player .videoAdUiAttribution'
-        wait = Wait(self.marionette, timeout=5)
+        wait = Wait(self.marionette, timeout=5, clock=self.clock)
         try:
             with self.marionette.using_context('content'):
                 wait.until(expected.element_present(By.CSS_SELECTOR,
@@ -313,15 +556,21 @@ class YouTubePuppeteer(VideoPuppeteer):
         # `current_time` stands still while ad is playing
         def condition():
             # no ad is playing and current_time stands still
-            return (not self.ad_playing and
-                    self.measure_progress() < 0.1 and
-                    self.player_measure_progress() < 0.1 and
-                    (self.player_playing or self.player_buffering))
+            before = self.snapshot()
+            if before.ad_playing:
+                return False
+            self.clock.sleep(1)
+            after = self.snapshot()
+            return (not after.ad_playing and
+                    after.current_time - before.current_time < 0.1 and
+                    (after.player_current_time -
+                     before.player_current_time) < 0.1 and
+                    (after.player_playing or after.player_buffering))
 
         if condition():
-            sleep(2)
+            self.clock.sleep(2)
             if self.player_buffering:
-                sleep(5)
+                self.clock.sleep(5)
             return condition()
         else:
             return False
@@ -332,7 +581,7 @@ class YouTubePuppeteer(VideoPuppeteer):
         """
         element_id = 'autoplay-checkbox'
         mn = self.marionette
-        wait = Wait(mn, timeout=10)
+        wait = Wait(mn, timeout=10, clock=self.clock)
 
         def get_status(el):
             script = 'return arguments[0].wrappedJSObject.checked'
@@ -348,7 +597,7 @@ class YouTubePuppeteer(VideoPuppeteer):
                 # button is rerendered after sidebar ads appear & the autoplay
                 # pref resets to "on". In other words, if you click too early,
                 # the pref might get reset moments later.
-                sleep(1)
+                self.clock.sleep(1)
                 if get_status(checkbox):
                     mn.execute_script('return arguments[0].'
                                       'wrappedJSObject.click()',
@@ -360,25 +609,25 @@ class YouTubePuppeteer(VideoPuppeteer):
         except (NoSuchElementException, TimeoutException):
             return False
 
-    def __str__(self):
-        messages = [super(YouTubePuppeteer, self).__str__()]
-        if self.player:
-            player_state = self._yt_player_state_name[self.player_state]
-            ad_state = self._yt_player_state_name[self.ad_state]
+    def _state_messages(self, state):
+        messages = super(YouTubePuppeteer, self)._state_messages(state)
+        if isinstance(state, YouTubeSnapshot):
+            player_state = self._yt_player_state_name.get(state.player_state)
+            ad_state = self._yt_player_state_name.get(state.ad_state)
             messages += [
                 '#movie_player: {',
-                '\tvideo id: {0},'.format(self.movie_id),
-                '\tvideo_title: {0}'.format(self.movie_title),
+                '\tvideo id: {0},'.format(state.movie_id),
+                '\tvideo_title: {0}'.format(state.movie_title),
                 '\tcurrent_state: {0},'.format(player_state),
                 '\tad_state: {0},'.format(ad_state),
-                '\tplayback_quality: {0},'.format(self.playback_quality),
-                '\tcurrent_time: {0},'.format(self.player_current_time),
-                '\tduration: {0},'.format(self.player_duration),
+                '\tplayback_quality: {0},'.format(state.playback_quality),
+                '\tcurrent_time: {0},'.format(state.player_current_time),
+                '\tduration: {0},'.format(state.player_duration),
                 '}'
             ]
         else:
             messages += ['\t#movie_player: None']
-        return '\n'.join(messages)
+        return messages
 
 
 def playback_started(yt):
@@ -386,12 +635,11 @@ def playback_started(yt):
     Check whether playback has started.
     :param yt: YouTubePuppeteer
     """
+    state = yt.snapshot()
     # usually, ad is playing during initial buffering
-    if (yt.player_state in
-            [yt._yt_player_state['PLAYING'],
-             yt._yt_player_state['BUFFERING']]):
+    if state.player_playing or state.player_buffering:
         return True
-    if yt.current_time > 0 or yt.player_current_time > 0:
+    if state.current_time > 0 or state.player_current_time > 0:
         return True
     return False
 
@@ -401,37 +649,114 @@ def playback_done(yt):
     Check whether playback is done, skipping ads if possible.
     :param yt: YouTubePuppeteer
     """
+    state = yt.snapshot()
     # in case ad plays at end of video
-    if yt.ad_state == yt._yt_player_state['PLAYING']:
+    if state.ad_playing:
         yt.attempt_ad_skip()
         return False
-    return yt.player_ended or yt.player_remaining_time < 1
+    if state.player_ended or state.player_remaining_time < 1:
+        yt.marks.mark('playback_done')
+        return True
+    return False
+
+
+class AdaptivePoller(object):
+    """
+    Decides how long to wait between checks of a playing YouTube video.
+
+    While playback is smooth, the wait doubles after every check, up to
+    `max_interval`. It drops back to `min_interval` as soon as there is a
+    sign of trouble: no progress since the last check, an ad playing or
+    less than `low_buffer` seconds buffered ahead. The wait never goes past
+    the point where the buffer would run low, the next boundary of interest
+    or, while ad breaks are scheduled, `ad_interval`.
+
+    Inputs:
+        min_interval - Shortest wait in seconds.
+        max_interval - Longest wait in seconds.
+        low_buffer - Seconds buffered ahead below which playback is at risk.
+        ad_interval - Longest wait in seconds while ad breaks remain.
+        stall_threshold - Seconds without progress after which playback is
+            considered stalled.
+    """
+    def __init__(self, min_interval=1, max_interval=60, low_buffer=10,
+                 ad_interval=30, stall_threshold=8):
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.low_buffer = low_buffer
+        self.ad_interval = ad_interval
+        self.stall_threshold = stall_threshold
+        self.interval = min_interval
+        self.last = None
+        self.stalled_since = None
+
+    def update(self, state):
+        """
+        Account for `state`, a YouTubeSnapshot taken since the last call.
+
+        :return: seconds for which the player has made no progress, outside
+            of ads
+        """
+        last, self.last = self.last, state
+        if (last is None or state.ad_playing or last.ad_playing or
+                not (state.player_playing or state.player_buffering) or
+                state.player_current_time - last.player_current_time >= 0.1):
+            self.stalled_since = None
+            return 0
+        if self.stalled_since is None:
+            self.stalled_since = last.wall_time
+        return state.wall_time - self.stalled_since
+
+    def next_delay(self, state, boundary):
+        """
+        :param state: the YouTubeSnapshot last passed to update
+        :param boundary: media seconds until the next point of interest
+        :return: seconds to wait before the next check
+        """
+        rate = float(state.playback_rate or 1)
+        ahead = state.buffered_ahead
+        if (self.stalled_since is not None or state.ad_playing or
+                ahead < self.low_buffer):
+            self.interval = self.min_interval
+        else:
+            self.interval = min(self.max_interval, self.interval * 2)
+        delay = min(self.interval, (ahead - self.low_buffer) / rate,
+                    boundary / rate)
+        if state.breaks_count > 0:
+            delay = min(delay, self.ad_interval)
+        return max(delay, self.min_interval)
 
 
-def wait_for_almost_done(yt, final_piece=120):
+def wait_for_almost_done(yt, final_piece=120, poller=None):
     """
     Allow the given video to play until only `final_piece` seconds remain,
     skipping ads mid-way as much as possible.
     `final_piece` should be short enough to not be interrupted by an ad.
 
-    Depending on the length of the video, check the ad status every 10-30
-    seconds, skip an active ad if possible.
+    Checks are scheduled by an AdaptivePoller: sparse during smooth
+    playback, dense near the end and when playback is in trouble. An ad
+    that is playing is skipped if possible.
 
     :param yt: YouTubePuppeteer
+    :param poller: optional AdaptivePoller
+    :raises VideoException: if playback stalls for poller.stall_threshold
+        seconds while the player is not buffering
     """
-    rest = 10
     duration = remaining_time = yt.expected_duration
     if duration < final_piece:
         # video is short so don't attempt to skip more ads
         return duration
-    elif duration > 600:
-        # for videos that are longer than 10 minutes
-        # wait longer between checks
-        rest = duration/50
-
-    while remaining_time > final_piece:
-        if yt.player_stalled:
-            if yt.player_buffering:
+    poller = poller or AdaptivePoller()
+    state = yt.snapshot()
+    while True:
+        # TODO during an ad, remaining_time will be based on ad's current_time
+        # rather than current_time of target video
+        remaining_time = state.player_remaining_time
+        if remaining_time <= final_piece:
+            break
+        stalled_for = poller.update(state)
+        if stalled_for >= poller.stall_threshold:
+            if state.player_buffering:
                 # fall back on timeout in 'wait' call that comes after this
                 # in test function
                 yt.marionette.log('Buffering and no playback progress.')
@@ -439,13 +764,10 @@ def wait_for_almost_done(yt, final_piece=120):
             else:
                 message = '\n'.join(['Playback stalled', str(yt)])
                 raise VideoException(message)
-        if yt.breaks_count > 0:
+        if state.ad_playing:
             yt.process_ad()
-        if remaining_time > 1.5 * rest:
-            sleep(rest)
         else:
-            sleep(rest/2)
-        # TODO during an ad, remaining_time will be based on ad's current_time
-        # rather than current_time of target video
-        remaining_time = yt.player_remaining_time
+            yt.clock.sleep(poller.next_delay(state,
+                                             remaining_time - final_piece))
+        state = yt.snapshot()
     return remaining_time